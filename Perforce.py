@@ -18,89 +18,1398 @@
 import sublime
 import sublime_plugin
 
+import collections
+import difflib
+import gzip
+import hashlib
+import json
 import os
+import socket
+import Queue
+import re
 import stat
+import struct
 import subprocess
+import sys
 import tempfile
 import threading
+import time
 
 # Plugin Settings are located in 'perforce.sublime-settings' make a copy in the User folder to keep changes
 
-# Utility functions
-def GetUserFromClientspec():
-    command = 'p4 info'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
+# Perforce output parsing section
+# p4 -G writes one marshalled dictionary per record, they are decoded as they arrive instead of scraping text
+E_WARN = 2 # severity of messages such as "file(s) not opened on this client."
+
+class PerforceRecord(dict):
+    def GetCode(self):
+        return self.get('code', 'stat')
+
+    def IsError(self):
+        return self.GetCode() == 'error' and int(self.get('severity', E_WARN + 1)) >= E_WARN
+
+    def IsData(self):
+        return self.GetCode() in ('text', 'binary')
+
+    def GetList(self, in_field):
+        # list fields are flattened as Field0, Field1, ...
+        values = []
+        while(in_field + str(len(values)) in self):
+            values.append(self[in_field + str(len(values))])
+        return values
+
+    def GetMessage(self):
+        if(self.GetCode() != 'stat'):
+            return self.get('data', '').rstrip('\n')
+
+        if(not 'depotFile' in self):
+            return ' '.join([key + ' ' + str(value) for key, value in sorted(self.items()) if key != 'code'])
+
+        message = self['depotFile']
+        revision = self.get('rev', self.get('workRev', self.get('haveRev')))
+        if(revision):
+            message += '#' + revision
+
+        if('oldAction' in self):
+            message += ' - was ' + self['oldAction'] + ', ' + self.get('action', 'reverted')
+        elif('action' in self):
+            message += ' - opened for ' + self['action']
+        elif('clientFile' in self):
+            message += ' - ' + self['clientFile']
+        return message
+
+def FormatRecords(in_records):
+    output = []
+    for record in in_records:
+        if(record.IsData()):
+            output.append(record['data'])
+        else:
+            output.append(record.GetMessage() + '\n')
+    return ''.join(output)
+
+# Performance statistics section
+# Every p4 process is timed and attributed to the command or event that caused it
+def GetCacheDirectory():
+    if(hasattr(sublime, 'cache_path')):
+        cacheroot = sublime.cache_path()
+    else:
+        cacheroot = os.path.join(os.path.dirname(sublime.packages_path()), 'Cache')
+    return os.path.join(cacheroot, 'Perforce')
+
+class PerforceStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.Reset()
+
+    def Reset(self):
+        self.lock.acquire()
+        try:
+            self.commands = {}
+            self.caches = {}
+            self.started = time.time()
+            self.trace = collections.deque(maxlen=sublime.load_settings('Perforce.sublime-settings').get('perforce_trace_size') or 1000)
+        finally:
+            self.lock.release()
+
+    def SetEntryPoint(self, in_entrypoint):
+        # background workers run on behalf of whoever queued the work
+        self.local.entrypoint = in_entrypoint
+
+    def GetEntryPoint(self):
+        entrypoint = getattr(self.local, 'entrypoint', None)
+        if(entrypoint):
+            return entrypoint
+
+        # otherwise the innermost command, event listener or thread on the stack
+        frame = sys._getframe(1)
+        while(frame is not None):
+            instance = frame.f_locals.get('self')
+            if(isinstance(instance, (sublime_plugin.EventListener, sublime_plugin.TextCommand, sublime_plugin.WindowCommand, threading.Thread)) and instance.__class__ is not threading.Thread):
+                return instance.__class__.__name__ + '.' + frame.f_code.co_name
+            frame = frame.f_back
+        return 'unknown'
+
+    def AddCommand(self, in_command, in_entrypoint, in_start, in_wait, in_duration, in_success):
+        self.lock.acquire()
+        try:
+            stats = self.commands.setdefault((in_command, in_entrypoint), [0, 0, 0.0, 0.0, 0.0])
+            stats[0] += 1
+            if(not in_success):
+                stats[1] += 1
+            stats[2] += in_duration
+            stats[3] = max(stats[3], in_duration)
+            stats[4] += in_wait
+            self.trace.append((in_command, in_entrypoint, in_start, in_duration, threading.currentThread().getName()))
+        finally:
+            self.lock.release()
+
+    def CountCache(self, in_cache, in_hit):
+        self.lock.acquire()
+        try:
+            stats = self.caches.setdefault(in_cache, [0, 0])
+            if(in_hit):
+                stats[0] += 1
+            else:
+                stats[1] += 1
+        finally:
+            self.lock.release()
+
+    def Format(self):
+        self.lock.acquire()
+        try:
+            commands = sorted(self.commands.items(), key=lambda item: -item[1][2])
+            caches = sorted(self.caches.items())
+            elapsed = time.time() - self.started
+        finally:
+            self.lock.release()
+
+        lines = ["Perforce plugin statistics for the last %.0f seconds" % elapsed, ""]
+        lines.append("%-12s %-55s %7s %7s %10s %10s %10s %10s" % ("command", "entry point", "calls", "failed", "total ms", "avg ms", "max ms", "queued ms"))
+        for (command, entrypoint), (count, failed, total, longest, waited) in commands:
+            lines.append("%-12s %-55s %7d %7d %10.0f %10.1f %10.1f %10.0f" % (command, entrypoint, count, failed, total * 1000, total * 1000 / count, longest * 1000, waited * 1000))
+
+        lines.append("")
+        lines.append("%-30s %10s %10s %10s" % ("cache", "hits", "misses", "hit rate"))
+        for cache, (hits, misses) in caches:
+            lines.append("%-30s %10d %10d %9.0f%%" % (cache, hits, misses, 100.0 * hits / max(1, hits + misses)))
+        return '\n'.join(lines) + '\n'
+
+    def DumpTrace(self, in_filename):
+        # chrome://tracing format
+        self.lock.acquire()
+        try:
+            events = []
+            for command, entrypoint, start, duration, thread in self.trace:
+                events.append({'name': command, 'cat': entrypoint, 'ph': 'X', 'pid': 0, 'tid': thread,
+                    'ts': int((start - self.started) * 1000000), 'dur': int(duration * 1000000)})
+            caches = dict([(cache, {'hits': hits, 'misses': misses}) for cache, (hits, misses) in self.caches.items()])
+        finally:
+            self.lock.release()
+
+        tracefile = open(in_filename, 'w')
+        try:
+            json.dump({'traceEvents': events, 'caches': caches}, tracefile, indent=1)
+        finally:
+            tracefile.close()
+
+perforce_stats = PerforceStats()
+
+def StartBackgroundThread(function, *args):
+    # the thread's p4 calls are attributed to whoever started it
+    entrypoint = perforce_stats.GetEntryPoint()
+
+    def run():
+        perforce_stats.SetEntryPoint(entrypoint)
+        function(*args)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+def ShowOutputPanel(window, name, text):
+    panel = window.get_output_panel(name)
+    edit = panel.begin_edit()
+    panel.insert(edit, 0, text)
+    panel.end_edit(edit)
+    window.run_command('show_panel', {'panel': 'output.' + name})
+    return panel
+
+def AppendToOutputPanel(panel, text):
+    edit = panel.begin_edit()
+    panel.insert(edit, panel.size(), text)
+    panel.end_edit(edit)
+    panel.show(panel.size())
+
+class PerforceShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        ShowOutputPanel(self.window, 'perforce_stats', perforce_stats.Format())
 
-    if(err):
-        WarnUser(err.strip())
-        return -1 
-
-    # locate the line containing "User name: " and extract the following name
-    startindex = result.find("User name: ")
-    if(startindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
-        return -1
-    
-    startindex += 11 # advance after 'User name: '
+class PerforceDumpPerformanceTraceCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(not os.path.isdir(GetCacheDirectory())):
+            os.makedirs(GetCacheDirectory())
+        tracefilename = os.path.join(GetCacheDirectory(), 'trace-' + time.strftime('%Y%m%d-%H%M%S') + '.json')
+        perforce_stats.DumpTrace(tracefilename)
+        self.window.open_file(tracefilename)
+
+class PerforceResetPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        perforce_stats.Reset()
+
+# Command runner section
+# every p4 process of the plugin is started here: argument lists without a shell, a timeout and a cap on concurrent processes
+PERFORCE_OPTIONS_WITH_VALUE = ('-b', '-c', '-C', '-d', '-H', '-L', '-p', '-P', '-Q', '-r', '-u', '-x', '-z')
+
+# commands that don't talk to the server, they still run while working offline
+PERFORCE_LOCAL_COMMANDS = ('set',)
+
+# identical queries running at the same time share a single p4 process
+PERFORCE_READ_ONLY_COMMANDS = ('annotate', 'changes', 'clients', 'describe', 'filelog', 'fstat', 'have', 'info', 'opened', 'print', 'where')
+
+def GetCommandIndex(in_arguments):
+    index = 0
+    while(index < len(in_arguments)):
+        argument = in_arguments[index]
+        if(not argument.startswith('-')):
+            return index
+        if(argument in PERFORCE_OPTIONS_WITH_VALUE):
+            index += 1
+        index += 1
+    return len(in_arguments)
+
+def GetCommandName(in_arguments):
+    index = GetCommandIndex(in_arguments)
+    if(index < len(in_arguments)):
+        return in_arguments[index]
+    return ''
+
+class IncompleteRecord(Exception):
+    pass
+
+def DecodeMarshalValue(in_buffer, in_offset):
+    # p4 -G uses marshal version 0: dictionaries of strings and integers
+    if(in_offset >= len(in_buffer)):
+        raise IncompleteRecord()
+    kind = in_buffer[in_offset]
+    offset = in_offset + 1
+    if(kind == '{'):
+        value = {}
+        while(True):
+            if(offset >= len(in_buffer)):
+                raise IncompleteRecord()
+            if(in_buffer[offset] == '0'):
+                return value, offset + 1
+            key, offset = DecodeMarshalValue(in_buffer, offset)
+            value[key], offset = DecodeMarshalValue(in_buffer, offset)
+    if(kind in 'stui'):
+        if(offset + 4 > len(in_buffer)):
+            raise IncompleteRecord()
+        number = struct.unpack('<i', in_buffer[offset:offset + 4])[0]
+        offset += 4
+        if(kind == 'i'):
+            return number, offset
+        if(offset + number > len(in_buffer)):
+            raise IncompleteRecord()
+        value = in_buffer[offset:offset + number]
+        if(kind == 'u'):
+            value = value.decode('utf-8')
+        return value, offset + number
+    if(kind == 'N'):
+        return None, offset
+    if(kind in 'TF'):
+        return kind == 'T', offset
+    raise ValueError("unexpected marshal type " + repr(kind))
+
+def ReadMarshalRecords(in_file):
+    # marshal.load blocks inside C while holding the interpreter lock, which would freeze every other
+    # thread (including the one feeding p4's stdin) until p4 answers; os.read releases it while waiting
+    fd = in_file.fileno()
+    data = ''
+    offset = 0
+    while(True):
+        chunk = os.read(fd, 65536)
+        if(not chunk):
+            return
+        data = data[offset:] + chunk
+        offset = 0
+        while(True):
+            try:
+                record, end = DecodeMarshalValue(data, offset)
+            except IncompleteRecord:
+                break
+            offset = end
+            yield record
+
+def ReadTextChunks(in_file):
+    fd = in_file.fileno()
+    while(True):
+        chunk = os.read(fd, 65536)
+        if(not chunk):
+            return
+        yield {'code': 'text', 'data': chunk}
 
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
-        return -1
+def GetStartupInfo():
+    # keep Windows from flashing a console for every p4 process
+    if(os.name != 'nt'):
+        return None
+    startupinfo = subprocess.STARTUPINFO()
+    startupinfo.dwFlags |= getattr(subprocess, 'STARTF_USESHOWWINDOW', 1)
+    return startupinfo
 
-    return result[startindex:endindex].strip();
+def WriteProcessInput(process, in_input):
+    try:
+        try:
+            process.stdin.write(in_input)
+        finally:
+            process.stdin.close()
+    except IOError:
+        pass # p4 exited without reading everything, the error is reported on stdout
+
+class PerforceStartError(Exception):
+    pass
+
+def KillProcess(process, killed):
+    killed.append(process)
+    try:
+        process.kill()
+    except OSError:
+        pass # already exited
+
+class PerforceCancellation(object):
+    # lets the user stop long running commands such as sync, every process started with it is killed
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = []
+        self.cancelled = False
+
+    def Attach(self, process, killed):
+        self.lock.acquire()
+        try:
+            if(self.cancelled):
+                KillProcess(process, killed)
+            else:
+                self.processes.append((process, killed))
+        finally:
+            self.lock.release()
+
+    def Cancel(self):
+        self.lock.acquire()
+        try:
+            self.cancelled = True
+            for process, killed in self.processes:
+                KillProcess(process, killed)
+            self.processes = []
+        finally:
+            self.lock.release()
+
+    def IsCancelled(self):
+        return self.cancelled
+
+class PerforceQuery(object):
+    def __init__(self):
+        self.finished = threading.Event()
+        self.records = []
+        self.errors = ["p4 query did not complete"]
+
+class PerforceRunner(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = None
+        self.slotcount = 0
+        self.inflight = {}
+
+    def GetTimeout(self, in_arguments):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        timeouts = perforce_settings.get('perforce_command_timeouts') or {}
+        command = GetCommandName(in_arguments)
+        if(command in timeouts):
+            return timeouts[command]
+        return perforce_settings.get('perforce_command_timeout')
 
-def GetClientRoot(in_dir):
-    # check if the file is in the depot
-    command = 'p4 info'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
+    def AcquireSlot(self):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        limit = max(1, perforce_settings.get('perforce_max_concurrent_commands') or 1)
+
+        self.lock.acquire()
+        try:
+            if(self.slots is None or self.slotcount != limit):
+                self.slots = threading.BoundedSemaphore(limit)
+                self.slotcount = limit
+            slots = self.slots
+        finally:
+            self.lock.release()
+
+        # release the same semaphore even if the limit changes while the command runs
+        slots.acquire()
+        return slots
+
+    def GetKillMessage(self, in_timeout, in_cancellation):
+        if(in_cancellation and in_cancellation.IsCancelled()):
+            return "p4 was cancelled"
+        return "p4 did not answer within " + str(in_timeout) + " seconds"
+
+    def Start(self, in_arguments, in_input, in_folder, in_cancellation = None):
+        # without a shell a missing p4 raises instead of printing to stderr, callers report it like any p4 error
+        try:
+            p = subprocess.Popen(['p4'] + in_arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_folder, startupinfo=GetStartupInfo())
+        except OSError, e:
+            raise PerforceStartError("p4 could not be started: " + str(e))
+
+        # feed stdin from another thread, p4 may start answering before it has read all of it
+        writer = threading.Thread(target=WriteProcessInput, args=(p, in_input or ''))
+        writer.start()
+
+        # a hung server must not keep a worker waiting forever, kill p4 once the timeout expires
+        timeout = self.GetTimeout(in_arguments)
+        killed = []
+        timer = None
+        if(timeout):
+            timer = threading.Timer(timeout, KillProcess, [p, killed])
+            timer.start()
+
+        if(in_cancellation):
+            in_cancellation.Attach(p, killed)
+
+        return p, writer, timer, killed, timeout
+
+    def GetWorkspaceArguments(self, in_arguments, in_folder):
+        # commands run from a folder use the workspace containing it, unless the caller picked a client
+        if(in_folder is None or '-c' in in_arguments[:GetCommandIndex(in_arguments)]):
+            return []
+        return GetClientArguments(workspace_registry.GetClient(in_folder))
+
+    def IsOffline(self, in_arguments):
+        # while the server is unreachable commands fail right away instead of waiting for the connection to time out
+        return not GetCommandName(in_arguments) in PERFORCE_LOCAL_COMMANDS and connectivity_monitor.IsOffline()
+
+    def Records(self, in_arguments, in_input = None, in_folder = None, in_cancellation = None):
+        return self.Read(['-G'] + in_arguments, ReadMarshalRecords, in_input, in_folder, in_cancellation)
+
+    def Stream(self, in_arguments, in_input = None, in_folder = None, in_cancellation = None):
+        # plain text output as 'text' records, one per chunk p4 writes, for long outputs shown while p4 still runs
+        return self.Read(in_arguments, ReadTextChunks, in_input, in_folder, in_cancellation)
+
+    def Read(self, in_arguments, in_reader, in_input, in_folder, in_cancellation):
+        if(self.IsOffline(in_arguments)):
+            yield PerforceRecord({'code': 'error', 'severity': 3, 'data': OFFLINE_MESSAGE})
+            return
 
-    if(err):
-        WarnUser(err.strip())
-        return -1 
-    
-    # locate the line containing "Client root: " and extract the following path
-    startindex = result.find("Client root: ")
-    if(startindex == -1):
-        # sometimes the clientspec is not displayed 
-        sublime.error_message("Perforce Plugin: p4 info didn't supply a valid clientspec, launching p4 client");
-        command = 'p4 client'
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-        result, err = p.communicate()
-        return -1
-            
-    startindex += 13 # advance after 'Client root: '
+        in_arguments = self.GetWorkspaceArguments(in_arguments, in_folder) + in_arguments
+        entrypoint = perforce_stats.GetEntryPoint()
+        queued = time.time()
+        slots = self.AcquireSlot()
+        start = time.time()
+        try:
+            try:
+                p, writer, timer, killed, timeout = self.Start(in_arguments, in_input, in_folder, in_cancellation)
+            except PerforceStartError, e:
+                yield PerforceRecord({'code': 'error', 'severity': 3, 'data': str(e)})
+                return
+
+            finished = False
+            try:
+                for record in in_reader(p.stdout):
+                    record = PerforceRecord(record)
+                    if(record.GetCode() == 'error'):
+                        connectivity_monitor.CheckError(record.GetMessage())
+                    yield record
+
+                err = p.stderr.read()
+                finished = True
+                if(killed):
+                    err = self.GetKillMessage(timeout, in_cancellation)
+                if(err.strip()):
+                    connectivity_monitor.CheckError(err)
+                    yield PerforceRecord({'code': 'error', 'severity': 3, 'data': err})
+            finally:
+                if(timer):
+                    timer.cancel()
+                if(not finished):
+                    # the caller stopped reading early, don't leave p4 blocked on a full pipe
+                    KillProcess(p, [])
+                p.stdout.close()
+                p.stderr.close()
+                writer.join()
+                p.wait()
+                perforce_stats.AddCommand(GetCommandName(in_arguments), entrypoint, start, start - queued, time.time() - start, finished and not killed)
+        finally:
+            slots.release()
+
+    def Collect(self, in_arguments, in_input, in_folder):
+        # per file errors are reported as records while the other files are still listed
+        records = []
+        errors = []
+        for record in self.Records(in_arguments, in_input, in_folder):
+            if(record.IsError()):
+                errors.append(record.GetMessage())
+            elif(record.GetCode() != 'error'):
+                records.append(record)
+        return records, errors
+
+    def Run(self, in_arguments, in_input = None, in_folder = None):
+        if(not GetCommandName(in_arguments) in PERFORCE_READ_ONLY_COMMANDS):
+            return self.Collect(in_arguments, in_input, in_folder)
+
+        key = (tuple(in_arguments), in_input, in_folder)
+        self.lock.acquire()
+        try:
+            query = self.inflight.get(key)
+            owner = query is None
+            if(owner):
+                query = PerforceQuery()
+                self.inflight[key] = query
+        finally:
+            self.lock.release()
+
+        perforce_stats.CountCache('shared queries', not owner)
+        if(not owner):
+            query.finished.wait()
+            return list(query.records), list(query.errors)
+
+        try:
+            query.records, query.errors = self.Collect(in_arguments, in_input, in_folder)
+        finally:
+            self.lock.acquire()
+            try:
+                del self.inflight[key]
+            finally:
+                self.lock.release()
+            query.finished.set()
+
+        return list(query.records), list(query.errors)
+
+    def Execute(self, in_arguments, in_input = None, in_folder = None, in_cancellation = None):
+        # plain text output, for forms and commands without tagged output
+        if(self.IsOffline(in_arguments)):
+            return '', OFFLINE_MESSAGE
+
+        in_arguments = self.GetWorkspaceArguments(in_arguments, in_folder) + in_arguments
+        entrypoint = perforce_stats.GetEntryPoint()
+        queued = time.time()
+        slots = self.AcquireSlot()
+        start = time.time()
+        try:
+            try:
+                p, writer, timer, killed, timeout = self.Start(in_arguments, in_input, in_folder, in_cancellation)
+            except PerforceStartError, e:
+                return '', str(e)
+            try:
+                result = p.stdout.read()
+                err = p.stderr.read()
+            finally:
+                if(timer):
+                    timer.cancel()
+                writer.join()
+                p.wait()
+                perforce_stats.AddCommand(GetCommandName(in_arguments), entrypoint, start, start - queued, time.time() - start, not killed and not err)
+        finally:
+            slots.release()
+
+        if(killed):
+            err = self.GetKillMessage(timeout, in_cancellation)
+        elif(err):
+            connectivity_monitor.CheckError(err)
+        return result, err
+
+perforce_runner = PerforceRunner()
+
+def PerforceRecords(in_arguments, in_input = None, in_folder = None, in_cancellation = None):
+    return perforce_runner.Records(in_arguments, in_input, in_folder, in_cancellation)
+
+def PerforceCommand(in_arguments, in_input = None, in_folder = None):
+    return perforce_runner.Run(in_arguments, in_input, in_folder)
+
+# Workspace info section
+class WorkspaceInfo(object):
+    def __init__(self, record):
+        self.record = record
+        self.user = record.get('userName')
+        self.client = record.get('clientName')
+        self.root = record.get('clientRoot')
+        self.server = record.get('serverAddress')
+
+def FindPerforceConfigFile(in_folder):
+    configname = os.environ.get('P4CONFIG')
+    if(not configname):
+        return None
+
+    folder = os.path.abspath(in_folder)
+    while(True):
+        candidate = os.path.join(folder, configname)
+        if(os.path.isfile(candidate)):
+            return candidate
+        parent = os.path.dirname(folder)
+        if(parent == folder):
+            return None
+        folder = parent
+
+def LoadWorkspaceFile(in_name, in_environment):
+    # the workspaces the server described in an earlier session, so they are known when starting offline
+    try:
+        cachefile = open(os.path.join(GetCacheDirectory(), in_name), 'r')
+        try:
+            data = json.load(cachefile)
+        finally:
+            cachefile.close()
+    except (IOError, ValueError):
+        return None
+    # tuples of the environment come back as lists
+    if(not isinstance(data, dict) or data.get('environment') != json.loads(json.dumps(in_environment))):
+        return None
+    return data
+
+def SaveWorkspaceFile(in_name, in_environment, in_data):
+    data = dict(in_data)
+    data['environment'] = in_environment
+    path = os.path.join(GetCacheDirectory(), in_name)
+    try:
+        if(not os.path.isdir(os.path.dirname(path))):
+            os.makedirs(os.path.dirname(path))
+        cachefile = open(path + '.tmp', 'w')
+        try:
+            json.dump(data, cachefile)
+        finally:
+            cachefile.close()
+        if(os.path.isfile(path)):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError):
+        pass
+
+class WorkspaceInfoCache(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {} # client name, None for the one p4 picks by itself -> (info, timestamp, environment)
+
+    def GetEnvironmentKey(self):
+        # p4 info depends on these, any change means the cached record describes another workspace
+        key = [os.environ.get(name) for name in ('P4CLIENT', 'P4PORT', 'P4USER', 'P4CONFIG')]
+
+        configfile = FindPerforceConfigFile(os.getcwd())
+        if(configfile):
+            try:
+                key.append((configfile, os.path.getmtime(configfile)))
+            except OSError:
+                key.append(configfile)
+
+        return key
+
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.entries = {}
+        finally:
+            self.lock.release()
+
+    def IsValid(self, entry, environment):
+        if(entry is None or environment != entry[2]):
+            return 0
+
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        ttl = perforce_settings.get('perforce_info_cache_ttl')
+        if(ttl is not None and time.time() - entry[1] > ttl):
+            return 0
+        return 1
+
+    def Get(self, in_folder = None):
+        environment = self.GetEnvironmentKey()
+
+        # the workspace of the folder is resolved first, it may need 'p4 info' of the default client itself
+        client = None
+        if(in_folder):
+            client = workspace_registry.GetClient(in_folder)
+
+        # holding the lock while p4 info runs makes concurrent callers share a single query
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(client)
+            valid = self.IsValid(entry, environment)
+            perforce_stats.CountCache('p4 info', valid)
+            if(valid):
+                return entry[0], None
+
+            # the last known workspace is still the best answer while the server can't be reached
+            if(connectivity_monitor.IsOffline()):
+                if(entry):
+                    return entry[0], None
+                saved = LoadWorkspaceFile('workspace_info.json', environment)
+                for name, record in (saved and saved['records'] or {}).items():
+                    # the record of the default client describes a workspace too
+                    if(name == (client or '') or (client and record.get('clientName') == client)):
+                        # no environment, it is queried again as soon as the server answers
+                        info = WorkspaceInfo(record)
+                        self.entries[client] = (info, 0, None)
+                        return info, None
+                return None, OFFLINE_MESSAGE
+
+            records, errors = PerforceCommand(GetClientArguments(client) + ['info'])
+
+            if(errors or not records):
+                self.entries.pop(client, None)
+                return None, '\n'.join(errors) or "Unexpected output from 'p4 info'."
+
+            info = WorkspaceInfo(records[0])
+            self.entries[client] = (info, time.time(), environment)
+            saved = {}
+            for name, entry in self.entries.items():
+                if(entry[2] == environment):
+                    saved[name or ''] = entry[0].record
+            SaveWorkspaceFile('workspace_info.json', environment, {'records': saved})
+            return info, None
+        finally:
+            self.lock.release()
+
+workspace_info_cache = WorkspaceInfoCache()
+
+def GetClientArguments(in_client):
+    if(in_client):
+        return ['-c', in_client]
+    return []
+
+def GetHostName():
+    return os.environ.get('P4HOST') or socket.gethostname()
+
+def IsSameHost(in_host, in_otherhost):
+    # p4 may know the machine by its short name or by its fully qualified one
+    in_host = in_host.lower()
+    in_otherhost = in_otherhost.lower()
+    return in_host == in_otherhost or in_host.split('.')[0] == in_otherhost.split('.')[0]
+
+def SplitPath(in_path):
+    return [component for component in NormalizePath(in_path).split(os.sep) if component]
+
+# Maps every folder to the workspace whose root contains it, one dictionary lookup per path component
+class ClientRootTrie(object):
+    def __init__(self):
+        self.root = {}
+
+    def Insert(self, in_path, in_client):
+        node = self.root
+        for component in SplitPath(in_path):
+            node = node.setdefault(component, {})
+        # None can't be a path component, it marks the end of a root
+        node.setdefault(None, in_client)
+
+    def Find(self, in_path):
+        node = self.root
+        client = node.get(None)
+        for component in SplitPath(in_path):
+            node = node.get(component)
+            if(node is None):
+                break
+            # nested roots resolve to the innermost workspace
+            client = node.get(None, client)
+        return client
+
+class WorkspaceRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trie = None
+        self.clients = {}
+        self.timestamp = 0
+        self.environment = None
+
+    def IsValid(self, environment):
+        if(self.trie is None or environment != self.environment):
+            return 0
+
+        ttl = sublime.load_settings('Perforce.sublime-settings').get('perforce_info_cache_ttl')
+        if(ttl is not None and time.time() - self.timestamp > ttl):
+            return 0
+        return 1
+
+    def Invalidate(self):
+        self.lock.acquire()
+        try:
+            self.trie = None
+        finally:
+            self.lock.release()
+
+    def Build(self, in_roots):
+        trie = ClientRootTrie()
+        for root, name in in_roots:
+            trie.Insert(root, name)
+        return trie
+
+    def Refresh(self, in_environment):
+        roots = []
+        clients = {}
+
+        info, err = workspace_info_cache.Get()
+        if(err or not info.user):
+            return self.Build(roots), clients
+
+        # the client p4 picks by itself always counts, even if its Host field names another machine
+        if(info.client and info.root):
+            clients[info.client] = info.root
+            roots.append([info.root, info.client])
+
+        host = GetHostName()
+        records, errors = PerforceCommand(['clients', '-u', info.user])
+        for record in records:
+            if(record.get('Host') and not IsSameHost(record['Host'], host)):
+                continue
+            name = record.get('client')
+            for root in [record.get('Root')] + record.GetList('AltRoots'):
+                if(name and root and root != 'null'):
+                    clients.setdefault(name, root)
+                    roots.append([root, name])
+
+        if(not errors):
+            SaveWorkspaceFile('workspace_roots.json', in_environment, {'roots': roots, 'clients': clients})
+        return self.Build(roots), clients
+
+    def Get(self):
+        environment = workspace_info_cache.GetEnvironmentKey()
+
+        self.lock.acquire()
+        try:
+            valid = self.IsValid(environment)
+            perforce_stats.CountCache('workspaces', valid)
+            if(not valid and connectivity_monitor.IsOffline()):
+                if(self.trie is None):
+                    # without an environment the roots are queried again as soon as the server answers
+                    saved = LoadWorkspaceFile('workspace_roots.json', environment)
+                    if(saved):
+                        self.trie = self.Build(saved['roots'])
+                        self.clients = saved['clients']
+                        self.environment = None
+                return self.trie or ClientRootTrie(), self.clients
+            if(not valid):
+                self.trie, self.clients = self.Refresh(environment)
+                self.timestamp = time.time()
+                self.environment = environment
+            return self.trie, self.clients
+        finally:
+            self.lock.release()
+
+    def GetClient(self, in_path):
+        trie, clients = self.Get()
+        return trie.Find(in_path)
+
+    def GetClients(self):
+        trie, clients = self.Get()
+        return dict(clients)
+
+workspace_registry = WorkspaceRegistry()
+
+class PerforceWorkspaceInfoListener(sublime_plugin.EventListener):
+    def on_post_save(self, view):
+        # editing the P4CONFIG file changes which workspace p4 talks to
+        configname = os.environ.get('P4CONFIG')
+        if(configname and view.file_name() and os.path.basename(view.file_name()) == configname):
+            workspace_info_cache.Invalidate()
+            workspace_registry.Invalidate()
+
+class PerforceRefreshWorkspaceInfoCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        workspace_info_cache.Invalidate()
+        workspace_registry.Invalidate()
+        file_state_index.Clear()
+        InvalidateChangelistStores()
+        info, err = workspace_info_cache.Get()
+        if(err):
+            WarnUser(err)
+        else:
+            clients = workspace_registry.GetClients()
+            LogResults(1, "Workspace info refreshed for client " + str(info.client) + ", " + str(len(clients)) + " workspaces on this host")
+
+# Offline section
+# When the server can't be reached files are made writable locally and the intended operations are journaled,
+# the journal is replayed once the server answers again
+OFFLINE_MESSAGE = "The Perforce server can't be reached, working offline."
+CONNECTION_ERRORS = ('Connect to server failed', 'TCP connect to', 'TCP receive failed', 'TCP send failed')
+PERFORCE_PROTOCOLS = ('tcp', 'tcp4', 'tcp6', 'tcp46', 'tcp64', 'ssl', 'ssl4', 'ssl6', 'ssl46', 'ssl64')
+
+def ParseServerAddress(in_port):
+    # [protocol:]host:port, or only the port of a server running on this machine
+    parts = in_port.strip().split(':')
+    if(parts and parts[0].lower() in PERFORCE_PROTOCOLS):
+        parts = parts[1:]
+    if(not parts or not parts[-1].isdigit()):
+        return None
+    host = ':'.join(parts[:-1]).strip('[]') or 'localhost'
+    return host, int(parts[-1])
+
+def ReadPerforceConfigValue(in_filename, in_name):
+    try:
+        configfile = open(in_filename, 'r')
+        try:
+            for line in configfile:
+                name, separator, value = line.partition('=')
+                if(separator and name.strip() == in_name):
+                    return value.strip()
+        finally:
+            configfile.close()
+    except IOError:
+        pass
+    return None
+
+class ConnectivityMonitor(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.online = None # unknown until the first probe
+        self.timestamp = 0
+        self.probing = False
+        self.address = None
+        self.addresskey = None
+
+    def IsEnabled(self):
+        return sublime.load_settings('Perforce.sublime-settings').get('perforce_offline_mode_enabled')
+
+    def GetServerAddress(self):
+        key = workspace_info_cache.GetEnvironmentKey()
+        if(key == self.addresskey):
+            return self.address
+
+        port = os.environ.get('P4PORT')
+        configfile = FindPerforceConfigFile(os.getcwd())
+        if(not port and configfile):
+            port = ReadPerforceConfigValue(configfile, 'P4PORT')
+        if(not port):
+            # p4 set reads the registry or the p4enviro file without contacting the server
+            result, err = perforce_runner.Execute(['set', '-q', 'P4PORT'])
+            port = result.strip().partition('=')[2]
+
+        self.address = port and ParseServerAddress(port) or None
+        self.addresskey = key
+        return self.address
+
+    def Probe(self):
+        # a plain TCP connection answers in milliseconds, p4 itself would wait for its own timeout
+        address = self.GetServerAddress()
+        if(address is None):
+            return True # nothing to probe, let p4 report the problem
+
+        timeout = sublime.load_settings('Perforce.sublime-settings').get('perforce_offline_probe_timeout')
+        try:
+            connection = socket.create_connection(address, timeout)
+            connection.close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+    def SetOnline(self, in_online):
+        self.lock.acquire()
+        try:
+            wasonline = self.online
+            self.online = in_online
+            self.timestamp = time.time()
+        finally:
+            self.lock.release()
+
+        if(wasonline is not False and not in_online):
+            ShowStatus("Perforce: " + OFFLINE_MESSAGE)
+            waiter = threading.Thread(target=self.WaitForServer)
+            waiter.setDaemon(True)
+            waiter.start()
+        elif(wasonline is False and in_online):
+            ShowStatus("Perforce: the server can be reached again")
+            offline_journal.RequestReplay()
+
+    def WaitForServer(self):
+        while(self.online is False):
+            time.sleep(sublime.load_settings('Perforce.sublime-settings').get('perforce_offline_probe_interval'))
+            if(self.online is False):
+                self.SetOnline(self.Probe())
+
+    def RequestProbe(self):
+        self.lock.acquire()
+        try:
+            if(self.probing):
+                return
+            self.probing = True
+        finally:
+            self.lock.release()
+
+        def probe():
+            try:
+                self.SetOnline(self.Probe())
+            finally:
+                self.probing = False
+        StartBackgroundThread(probe)
+
+    def IsOffline(self):
+        # never blocks, an old answer is used while a new probe runs in the background
+        if(not self.IsEnabled()):
+            return False
+        interval = sublime.load_settings('Perforce.sublime-settings').get('perforce_offline_probe_interval')
+        if(self.online is None or time.time() - self.timestamp > interval):
+            self.RequestProbe()
+        return self.online is False
+
+    def CheckError(self, in_message):
+        if(not self.IsEnabled()):
+            return
+        for error in CONNECTION_ERRORS:
+            if(in_message.find(error) != -1):
+                self.SetOnline(False)
+                return
+
+connectivity_monitor = ConnectivityMonitor()
+
+class OfflineJournal(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = None
+        self.replaying = False
+
+    def GetPath(self):
+        return os.path.join(GetCacheDirectory(), 'offline_journal.json')
+
+    def Load(self):
+        if(self.entries is not None):
+            return
+        try:
+            journalfile = open(self.GetPath(), 'r')
+            try:
+                self.entries = json.load(journalfile)
+            finally:
+                journalfile.close()
+        except (IOError, ValueError):
+            self.entries = []
+
+    def Save(self):
+        # written next to the journal and renamed so a crash never leaves half of it
+        path = self.GetPath()
+        if(not os.path.isdir(os.path.dirname(path))):
+            os.makedirs(os.path.dirname(path))
+        journalfile = open(path + '.tmp', 'w')
+        try:
+            json.dump(self.entries, journalfile, indent=1)
+        finally:
+            journalfile.close()
+        if(os.path.isfile(path)):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def Find(self, in_filename):
+        key = NormalizePath(in_filename)
+        for entry in self.entries:
+            if(NormalizePath(entry['file']) == key):
+                return entry
+        return None
+
+    def Get(self, in_filename):
+        self.lock.acquire()
+        try:
+            self.Load()
+            entry = self.Find(in_filename)
+            return entry and dict(entry)
+        finally:
+            self.lock.release()
+
+    def GetEntries(self):
+        self.lock.acquire()
+        try:
+            self.Load()
+            return [dict(entry) for entry in self.entries]
+        finally:
+            self.lock.release()
+
+    def Record(self, in_action, in_filename, in_source = None):
+        # redundant operations cancel out: edit then revert, add then delete, add then move...
+        self.lock.acquire()
+        try:
+            self.Load()
+            existing = self.Find(in_filename)
+
+            if(in_action in ('edit', 'add')):
+                if(existing is None):
+                    self.entries.append({'action': in_action, 'file': in_filename})
+                elif(existing['action'] == 'delete'):
+                    existing['action'] = 'edit' # deleted and created again
+            elif(in_action == 'delete'):
+                if(existing is None):
+                    self.entries.append({'action': 'delete', 'file': in_filename})
+                elif(existing['action'] == 'add'):
+                    self.entries.remove(existing)
+                elif(existing['action'] == 'move'):
+                    existing['action'] = 'delete'
+                    existing['file'] = existing.pop('source')
+                else:
+                    existing['action'] = 'delete'
+            elif(in_action == 'revert'):
+                if(existing is not None):
+                    self.entries.remove(existing)
+            elif(in_action == 'move'):
+                previous = self.Find(in_source)
+                if(previous is not None and previous['action'] == 'move' and NormalizePath(previous['source']) == NormalizePath(in_filename)):
+                    # moved back where it came from, what is left is the edit a writable file stands for
+                    self.entries.remove(previous)
+                    if(os.path.isfile(in_filename) and IsFileWritable(in_filename)):
+                        self.entries.append({'action': 'edit', 'file': in_filename})
+                elif(previous is not None and previous['action'] in ('add', 'move')):
+                    previous['file'] = in_filename # still the same add or the same move
+                else:
+                    if(previous is not None):
+                        self.entries.remove(previous)
+                    self.entries.append({'action': 'move', 'file': in_filename, 'source': in_source})
+
+            self.Save()
+        finally:
+            self.lock.release()
+
+    def Remove(self, in_entries):
+        self.lock.acquire()
+        try:
+            self.Load()
+            self.entries = [entry for entry in self.entries if not entry in in_entries]
+            self.Save()
+        finally:
+            self.lock.release()
+
+    def Replay(self):
+        entries = self.GetEntries()
+        if(not entries):
+            return 1, "The offline journal is empty."
+
+        errors = []
+        if(sublime.load_settings('Perforce.sublime-settings').get('perforce_offline_replay') == 'reconcile'):
+            # let the server work out what changed among the journaled files
+            filenames = [entry['file'] for entry in entries] + [entry['source'] for entry in entries if 'source' in entry]
+            errors.extend(PerforceBatch(['reconcile'], filenames)[1])
+        else:
+            moves = [entry for entry in entries if entry['action'] == 'move']
+            edits = [entry['file'] for entry in entries if entry['action'] == 'edit'] + [entry['source'] for entry in moves]
+            adds = [entry['file'] for entry in entries if entry['action'] == 'add']
+            deletes = [entry['file'] for entry in entries if entry['action'] == 'delete']
+            if(edits):
+                errors.extend(PerforceBatch(['edit'], edits)[1])
+            if(adds):
+                errors.extend(PerforceBatch(['add'], adds)[1])
+            if(deletes):
+                errors.extend(PerforceBatch(['delete'], deletes)[1])
+            if(moves):
+                # the files were already moved on disk, -k only moves them on the server
+                pairs = []
+                for entry in moves:
+                    pairs.extend([entry['source'], entry['file']])
+                errors.extend(PerforceBatch(['-b', '2', 'move', '-k'], pairs, 2)[1])
+
+        if(connectivity_monitor.IsOffline()):
+            return 0, OFFLINE_MESSAGE # lost the server again, keep everything for the next attempt
+
+        self.Remove(entries)
+        file_state_index.RequestRefresh([entry['file'] for entry in entries])
+        InvalidateChangelistStores()
+
+        message = "Replayed " + str(len(entries)) + " offline operations"
+        if(errors):
+            return 0, message + ":\n" + '\n'.join(errors)
+        return 1, message
+
+    def RequestReplay(self):
+        self.lock.acquire()
+        try:
+            if(self.replaying):
+                return
+            self.replaying = True
+        finally:
+            self.lock.release()
+
+        def replay():
+            try:
+                if(self.GetEntries()):
+                    success, message = self.Replay()
+                    sublime.set_timeout(lambda: LogResults(success, message), 0)
+            finally:
+                self.replaying = False
+        StartBackgroundThread(replay)
+
+offline_journal = OfflineJournal()
+
+def MakeFileWritable(in_filename):
+    os.chmod(in_filename, os.stat(in_filename).st_mode | stat.S_IWRITE)
+
+def OfflineCheckout(in_filename):
+    MakeFileWritable(in_filename)
+    offline_journal.Record('edit', in_filename)
+    return 1, in_filename + " - made writable, the edit will be sent once the server can be reached"
+
+def OfflineAdd(in_filename):
+    offline_journal.Record('add', in_filename)
+    return 1, in_filename + " - the add will be sent once the server can be reached"
+
+def OfflineDelete(in_filename):
+    if(os.path.isfile(in_filename)):
+        MakeFileWritable(in_filename)
+        os.remove(in_filename)
+    offline_journal.Record('delete', in_filename)
+    return 1, in_filename + " - deleted, the delete will be sent once the server can be reached"
+
+def OfflineRename(in_filename, in_newname):
+    os.rename(in_filename, in_newname)
+    if(os.path.isdir(in_newname)):
+        for dirpath, dirnames, filenames in os.walk(in_newname):
+            for filename in filenames:
+                newpath = os.path.join(dirpath, filename)
+                offline_journal.Record('move', newpath, os.path.join(in_filename, os.path.relpath(newpath, in_newname)))
+    else:
+        offline_journal.Record('move', in_newname, in_filename)
+    return 1, in_filename + " - moved to " + in_newname + ", the move will be sent once the server can be reached"
+
+def OfflineRevert(in_filename):
+    entry = offline_journal.Get(in_filename)
+    if(entry is None or not entry['action'] in ('edit', 'add')):
+        return 0, "Only offline edits and adds can be reverted while the server can't be reached."
+
+    if(entry['action'] == 'edit'):
+        # the have revision can only come back from the depot cache
+        state = file_state_index.Peek(in_filename)
+        objectpath = state and state.depotFile and state.haveRev and depot_cache.Lookup(state.depotFile, state.haveRev)
+        if(not objectpath):
+            return 0, "The depot revision of " + in_filename + " is not cached, it can't be reverted offline."
+        depot_cache.ExtractTo(state.depotFile, state.haveRev, in_filename)
+        os.chmod(in_filename, os.stat(in_filename).st_mode & ~stat.S_IWRITE)
+
+    offline_journal.Record('revert', in_filename)
+    return 1, in_filename + " - reverted offline"
+
+class PerforceReplayOfflineChangesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(connectivity_monitor.IsOffline()):
+            WarnUser(OFFLINE_MESSAGE)
+            return
+        offline_journal.RequestReplay()
 
-    endindex = result.find("\n", startindex) 
-    if(endindex == -1):
-        WarnUser("Unexpected output from 'p4 info'.")
-        return -1
+class PerforceShowOfflineChangesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        entries = offline_journal.GetEntries()
+        lines = []
+        for entry in entries:
+            if(entry['action'] == 'move'):
+                lines.append("move   " + entry['source'] + " -> " + entry['file'])
+            else:
+                lines.append(entry['action'].ljust(6) + " " + entry['file'])
+        ShowOutputPanel(self.window, 'perforce_offline', '\n'.join(lines) or "The offline journal is empty.")
+
+def ReplayPreviousSession():
+    # what was journaled before Sublime Text was closed is sent as soon as the server answers
+    if(offline_journal.GetEntries()):
+        connectivity_monitor.SetOnline(connectivity_monitor.Probe())
+        if(connectivity_monitor.online):
+            offline_journal.RequestReplay()
+
+sublime.set_timeout(lambda: StartBackgroundThread(ReplayPreviousSession), 2500)
+
+# Spec form section
+# Forms such as 'p4 change -o' are edited field by field and piped back to 'p4 <command> -i' through stdin
+class PerforceSpec(object):
+    def __init__(self):
+        self.fields = [] # [name, lines, multiline] in the order of the form
+
+    def Parse(in_text):
+        spec = PerforceSpec()
+        field = None
+        for line in in_text.splitlines():
+            if(line.startswith('#')):
+                continue
+            if(line.startswith('\t') or line.startswith(' ')):
+                if(field):
+                    field[1].append(line[1:])
+                continue
+            if(not line.strip()):
+                # blank lines separate fields, inside a value they are written as a single tab
+                field = None
+                continue
+
+            name, separator, value = line.partition(':')
+            if(not separator):
+                continue
+            value = value.strip()
+            field = [name, value and [value] or [], not value]
+            spec.fields.append(field)
+        return spec
+    Parse = staticmethod(Parse)
+
+    def FromRecord(in_record):
+        # 'p4 -G' forms flatten list fields as Files0, Files1, ...
+        spec = PerforceSpec()
+        names = []
+        for key in sorted(in_record.keys()):
+            name = key.rstrip('0123456789')
+            # spec fields are capitalized, the other keys are tagged output such as 'code'
+            if(key[:1].isupper() and not name in names):
+                names.append(name)
+
+        for name in names:
+            if(name in in_record):
+                value = in_record[name]
+                spec.fields.append([name, value.rstrip('\n').split('\n'), '\n' in value.rstrip('\n') or name == 'Description'])
+            else:
+                spec.fields.append([name, PerforceRecord(in_record).GetList(name), True])
+        return spec
+    FromRecord = staticmethod(FromRecord)
+
+    def Copy(self):
+        spec = PerforceSpec()
+        spec.fields = [[name, list(lines), multiline] for name, lines, multiline in self.fields]
+        return spec
+
+    def Find(self, in_name):
+        for field in self.fields:
+            if(field[0] == in_name):
+                return field
+        return None
+
+    def Get(self, in_name):
+        field = self.Find(in_name)
+        if(field is None):
+            return ''
+        return '\n'.join(field[1])
+
+    def GetList(self, in_name):
+        field = self.Find(in_name)
+        if(field is None):
+            return []
+        return list(field[1])
+
+    def Set(self, in_name, in_value):
+        if(isinstance(in_value, list)):
+            lines = list(in_value)
+        else:
+            lines = in_value.rstrip('\n').split('\n')
+        multiline = isinstance(in_value, list) or len(lines) > 1 or in_name == 'Description'
 
-    # convert all paths to "os.sep" slashes 
-    convertedclientroot = result[startindex:endindex].strip().lower().replace('\\', os.sep).replace('/', os.sep)
+        field = self.Find(in_name)
+        if(field is None):
+            self.fields.append([in_name, lines, multiline])
+        else:
+            field[1] = lines
+            field[2] = field[2] or multiline
 
-    return convertedclientroot
+    def Remove(self, in_name):
+        self.fields = [field for field in self.fields if field[0] != in_name]
 
+    def Format(self):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        separator = str(perforce_settings.get('perforce_end_line_separator') or '\n')
+
+        lines = []
+        for name, values, multiline in self.fields:
+            if(multiline):
+                lines.append(name + ':')
+                lines.extend(['\t' + value for value in values])
+            else:
+                lines.append(name + ':\t' + ''.join(values))
+            lines.append('')
+        return separator.join(lines)
 
+def SubmitSpec(in_command, in_spec, in_folder = None):
+    form = in_spec.Format()
+    if(isinstance(form, unicode)):
+        form = form.encode('utf-8')
+    result, err = perforce_runner.Execute([in_command, '-i'], form, in_folder)
+    return result.strip(), err.strip()
+
+# Utility functions
 def IsFolderUnderClientRoot(in_folder):
-    # check if the file is in the depot
-    clientroot = GetClientRoot(in_folder)
-    if(clientroot == -1):
-        return 0
+    # any workspace of this host will do, the commands on the file run with its client
+    if(workspace_registry.GetClient(in_folder)):
+        return 1
 
-    # convert all paths to "os.sep" slashes 
-    convertedfolder = in_folder.lower().replace('\\', os.sep).replace('/', os.sep);
-    clientrootindex = convertedfolder.find(clientroot); 
+    info, err = workspace_info_cache.Get()
+    if(err or not info.root):
+        return 0
 
-    if(clientrootindex == -1):
+    trie = ClientRootTrie()
+    trie.Insert(info.root, info.client)
+    if(trie.Find(in_folder) is None):
         return 0
     
     return 1
 
 def IsFileInDepot(in_folder, in_filename):
-    isUnderClientRoot = IsFolderUnderClientRoot(in_folder);
+    # the file state index answers without asking the server when it knows the file
+    state = file_state_index.Get(os.path.join(in_folder, in_filename))
+    if(state is None and connectivity_monitor.IsOffline()):
+        state = file_state_index.Peek(os.path.join(in_folder, in_filename))
+    if(state is not None):
+        isUnderClientRoot = state.mapped
+    else:
+        isUnderClientRoot = IsFolderUnderClientRoot(in_folder);
     if(os.path.isfile(os.path.join(in_folder, in_filename))): # file exists on disk, not being added
         if(isUnderClientRoot):
             return 1
@@ -112,81 +1421,45 @@ def IsFileInDepot(in_folder, in_filename):
         else:
             return 0
 
-def GetPendingChangelists():
-    # Launch p4 changes to retrieve all the pending changelists
-    currentuser = GetUserFromClientspec()
-    if(currentuser == -1):
-        return 0, "Unexpected output from 'p4 info'."
-
-    command = 'p4 changes -s pending -u ' + currentuser;  
-
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
-
-    if(not err):
-        return 1, result
-    return 0, result
-
-def AppendToChangelistDescription(changelist, input):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = 'p4 change -o ' + changelist
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
-
-    if(err):
-        return 0, err
-
-    # Find the description field and modify it
-    lines = result.splitlines()
-
-    descriptionindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Description:"):
-            descriptionindex = index
-            break;
-    
-    filesindex = -1
-    for index, line in enumerate(lines):
-        if(line.strip() == "Files:"):
-            filesindex = index
-            break;
-
-    if(filesindex == -1): # The changelist is empty
-        endindex = index
-    else:
-        endindex = filesindex - 1
-
-    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
-    lines.insert(endindex , "\t" + input)
-
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
-
-    try:
-        temp_changelist_description_file.write(perforce_settings.get('perforce_end_line_separator').join(lines))
-    finally:
-        temp_changelist_description_file.close()
-
-    command = 'p4 change -i < ' + temp_changelist_description_file.name
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
-
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
-
-    if(err):
-        return 0, err
+def GetPendingChangelists(in_folder = None):
+    # changelists of the current user in the workspace of the folder, sorted by number
+    return GetChangelistStore(in_folder).Get()
+
+def AppendToChangelistDescription(changelist, input, in_folder = None):
+    success, results = AppendToChangelistDescriptions([(changelist, input)], in_folder)
+    return results[0]
+
+def AppendToChangelistDescriptions(in_edits, in_folder = None):
+    # all the forms come from a single 'p4 change -o', each edited form is piped back to 'p4 change -i'
+    forms, errors = PerforceCommand(['-x', '-', 'change', '-o'], '\n'.join([changelist for changelist, line in in_edits]) + '\n', in_folder)
+    specs = {}
+    for form in forms:
+        specs[form.get('Change')] = PerforceSpec.FromRecord(form)
+
+    results = []
+    for changelist, line in in_edits:
+        spec = specs.get(changelist)
+        if(spec is None):
+            results.append((0, '\n'.join(errors) or "Could not read changelist " + changelist))
+            continue
+
+        spec.Set('Description', spec.Get('Description').rstrip('\n') + '\n' + line)
+        result, err = SubmitSpec('change', spec, in_folder)
+        if(err):
+            results.append((0, err))
+        else:
+            GetChangelistStore(in_folder).AppendToDescription(changelist, line)
+            results.append((1, result))
 
-    return 1, result
+    return len([result for result in results if result[0] != 1]) == 0, results
 
 def PerforceCommandOnFile(in_command, in_folder, in_filename):
-    command = 'p4 ' + in_command + ' "' + in_filename + '"'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_folder, shell=True)
-    result, err = p.communicate()
+    records, errors = PerforceCommand([in_command, in_filename], None, in_folder)
 
-    if(not err):
-        return 1, result.strip()
+    if(not errors):
+        return 1, FormatRecords(records).strip()
     else:
-        return 0, err.strip()   
+        return 0, '\n'.join(errors).strip()
 
 def WarnUser(message):
     perforce_settings = sublime.load_settings('Perforce.sublime-settings')
@@ -196,6 +1469,10 @@ def WarnUser(message):
         else:
             print "Perforce [warning]: " + message
 
+def ShowStatus(message):
+    # status_message must be called from the main thread
+    sublime.set_timeout(lambda: sublime.status_message(message), 0)
+
 def LogResults(success, message):
     if(success >= 0):
         print "Perforce: " + message
@@ -211,6 +1488,837 @@ def IsFileWritable(in_filename):
         return 1
     return 0
 
+def GroupFilesByWorkspace(in_filenames):
+    groups = {}
+    for filename in in_filenames:
+        groups.setdefault(workspace_registry.GetClient(filename), []).append(filename)
+    return groups
+
+def PerforceBatch(in_arguments, in_filenames, in_step = 1):
+    # one p4 -x - per workspace, in_step keeps the arguments of -b together (2 for the source and target of a move)
+    records = []
+    errors = []
+    groups = {}
+    for index in range(0, len(in_filenames), in_step):
+        groups.setdefault(workspace_registry.GetClient(in_filenames[index]), []).extend(in_filenames[index:index + in_step])
+    for client, filenames in groups.items():
+        clientrecords, clienterrors = PerforceCommand(GetClientArguments(client) + ['-x', '-'] + in_arguments, '\n'.join(filenames) + '\n')
+        records.extend(clientrecords)
+        errors.extend(clienterrors)
+    return records, errors
+
+def GetWindowFolder(window):
+    # the workspace of a window command is the one of the file being edited
+    view = window.active_view()
+    if(view and view.file_name()):
+        return os.path.dirname(view.file_name())
+    folders = window.folders()
+    if(folders):
+        return folders[0]
+    return None
+
+# File state index section
+# What the server knows about each local file, so most commands don't have to ask it again
+FILE_STATE_FIELDS = 'clientFile,depotFile,isMapped,haveRev,headRev,headAction,headType,action,change,type,otherOpen,otherLock'
+
+def NormalizePath(in_filename):
+    return os.path.normcase(os.path.abspath(in_filename))
+
+class FileState(object):
+    def __init__(self, record):
+        self.depotFile = record.get('depotFile')
+        self.mapped = 'isMapped' in record or 'action' in record
+        self.haveRev = record.get('haveRev')
+        self.headRev = record.get('headRev')
+        self.headAction = record.get('headAction')
+        self.action = record.get('action')
+        self.change = record.get('change')
+        self.type = record.get('type', record.get('headType'))
+        # other workspaces having the file opened, as user@client
+        self.otherOpen = PerforceRecord(record).GetList('otherOpen')
+        self.otherLock = 'otherLock' in record or len(PerforceRecord(record).GetList('otherLock')) > 0
+        self.timestamp = time.time()
+
+    def IsOpened(self):
+        return self.action is not None
+
+    def IsOutOfDate(self):
+        if(not self.haveRev or not self.headRev or not self.headRev.isdigit()):
+            return False
+        # 'none' when the file was deleted locally or never synced
+        return not self.haveRev.isdigit() or int(self.haveRev) < int(self.headRev)
+
+class FileStateIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.pending = set()
+        self.refreshing = False
+
+    def Peek(self, in_filename):
+        # whatever is known, however old, for display purposes
+        return self.states.get(NormalizePath(in_filename))
+
+    def Get(self, in_filename):
+        state = self.states.get(NormalizePath(in_filename))
+        if(state is None):
+            perforce_stats.CountCache('file states', False)
+            return None
+
+        # files can be opened or reverted outside of Sublime, old entries are refreshed instead of trusted
+        ttl = sublime.load_settings('Perforce.sublime-settings').get('perforce_file_state_ttl')
+        if(ttl is not None and time.time() - state.timestamp > ttl and not connectivity_monitor.IsOffline()):
+            perforce_stats.CountCache('file states', False)
+            self.RequestRefresh([in_filename])
+            return None
+
+        perforce_stats.CountCache('file states', True)
+        return state
+
+    def Clear(self):
+        self.lock.acquire()
+        try:
+            self.states = {}
+        finally:
+            self.lock.release()
+
+    def Forget(self, in_filename):
+        self.lock.acquire()
+        try:
+            self.states.pop(NormalizePath(in_filename), None)
+        finally:
+            self.lock.release()
+
+    def ForgetFolder(self, in_folder):
+        prefix = os.path.join(NormalizePath(in_folder), '')
+        self.lock.acquire()
+        try:
+            for key in [key for key in self.states if key.startswith(prefix)]:
+                del self.states[key]
+        finally:
+            self.lock.release()
+
+    def Update(self, in_filename, **in_fields):
+        # keep the index in sync with the commands the plugin runs itself
+        self.lock.acquire()
+        try:
+            state = self.states.get(NormalizePath(in_filename))
+            if(state):
+                for name, value in in_fields.items():
+                    setattr(state, name, value)
+                state.mapped = True
+        finally:
+            self.lock.release()
+
+    def Store(self, in_records):
+        # records are decoded while p4 runs, only the final merge holds the lock
+        states = {}
+        errors = []
+        for record in in_records:
+            if(record.IsError()):
+                # "<file> - no such file(s)." is a mapped file the depot doesn't have yet
+                message = record.GetMessage()
+                filename, separator, reason = message.rpartition(' - ')
+                if(separator and os.path.isabs(filename)):
+                    state = FileState({})
+                    state.mapped = reason.find('not in client view') == -1 and reason.find('not under client') == -1
+                    states[NormalizePath(filename)] = state
+                else:
+                    errors.append(message)
+            elif('clientFile' in record):
+                states[NormalizePath(record['clientFile'])] = FileState(record)
+
+        self.lock.acquire()
+        try:
+            self.states.update(states)
+        finally:
+            self.lock.release()
+        return errors
+
+    def Refresh(self, in_filenames):
+        # one fstat per workspace, a file is only known to the client whose root contains it
+        errors = []
+        for client, filenames in GroupFilesByWorkspace(in_filenames).items():
+            records = PerforceRecords(GetClientArguments(client) + ['-x', '-', 'fstat', '-T', FILE_STATE_FIELDS], '\n'.join(filenames) + '\n')
+            errors.extend(self.Store(records))
+        return errors
+
+    def RefreshClientRoot(self):
+        info, err = workspace_info_cache.Get()
+        if(err):
+            return 0, err
+
+        clients = workspace_registry.GetClients()
+        if(not clients and info.client):
+            clients[info.client] = info.root
+
+        for client in sorted(clients.keys()):
+            records = PerforceRecords(['-c', client, 'fstat', '-T', FILE_STATE_FIELDS, '//' + client + '/...'])
+            self.Store(records)
+        return 1, "Indexed " + str(len(self.states)) + " files of " + str(len(clients)) + " workspaces"
+
+    def RequestRefresh(self, in_filenames):
+        # refreshes run in the background and requests made meanwhile are merged into the next batch
+        self.lock.acquire()
+        try:
+            self.pending.update(in_filenames)
+            if(self.refreshing or not self.pending):
+                return
+            self.refreshing = True
+        finally:
+            self.lock.release()
+
+        StartBackgroundThread(self.RefreshPending)
+
+    def RefreshPending(self):
+        while(True):
+            self.lock.acquire()
+            try:
+                filenames = list(self.pending)
+                self.pending.clear()
+                if(not filenames):
+                    self.refreshing = False
+                    return
+            finally:
+                self.lock.release()
+
+            try:
+                self.Refresh(filenames)
+            except Exception, e:
+                WarnUser("Could not refresh file states: " + str(e))
+
+file_state_index = FileStateIndex()
+
+def GetOpenViewFiles():
+    filenames = []
+    for window in sublime.windows():
+        for view in window.views():
+            filename = view.file_name()
+            if(filename and os.path.isfile(filename) and not filename in filenames):
+                filenames.append(filename)
+    return filenames
+
+class PerforceFileStateListener(sublime_plugin.EventListener):
+    def on_load(self, view):
+        if(view.file_name() and not NormalizePath(view.file_name()) in file_state_index.states):
+            file_state_index.RequestRefresh([view.file_name()])
+
+class PerforceRefreshFileStatesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        def refresh():
+            file_state_index.Clear()
+            success, message = file_state_index.RefreshClientRoot()
+            sublime.set_timeout(lambda: LogResults(success, message), 0)
+        StartBackgroundThread(refresh)
+
+# index the views that are already open when the plugin loads
+sublime.set_timeout(lambda: file_state_index.RequestRefresh(GetOpenViewFiles()), 1000)
+
+# Pending changelist section
+# The pending changelists of the workspace with their file counts, shared by every changelist picker
+class PendingChangelist(object):
+    def __init__(self, number, description, filecount = 0, shelved = False):
+        self.number = number
+        self.description = description
+        self.filecount = filecount
+        self.shelved = shelved
+
+    def GetTitle(self):
+        lines = self.description.strip().splitlines()
+        if(lines):
+            return lines[0].strip()
+        return ''
+
+    def GetSummary(self):
+        summary = str(self.filecount) + (self.filecount == 1 and " file" or " files")
+        if(self.shelved):
+            summary += ", shelved"
+        return summary
+
+class PendingChangelistStore(object):
+    def __init__(self, in_client):
+        self.client = in_client
+        self.lock = threading.Lock()
+        self.refreshlock = threading.Lock()
+        self.changelists = None
+        self.timestamp = 0
+        self.refreshing = False
+
+    def IsStale(self):
+        ttl = sublime.load_settings('Perforce.sublime-settings').get('perforce_changelist_cache_ttl')
+        return ttl is not None and time.time() - self.timestamp > ttl
+
+    def GetChangelists(self):
+        self.lock.acquire()
+        try:
+            if(self.changelists is None):
+                return None
+            return self.changelists.values()
+        finally:
+            self.lock.release()
+
+    def Get(self):
+        # pickers get what is known right away, old data is refreshed in the background for the next time
+        changelists = self.GetChangelists()
+        if(changelists is None):
+            perforce_stats.CountCache('pending changelists', False)
+            success, message = self.Load()
+            if(not success):
+                return 0, message
+            changelists = self.GetChangelists() or []
+        else:
+            perforce_stats.CountCache('pending changelists', True)
+            if(self.IsStale()):
+                self.RequestRefresh()
+
+        changelists.sort(key=lambda changelist: int(changelist.number))
+        return 1, changelists
+
+    def Load(self):
+        # a picker opened while the first refresh runs waits for it instead of starting another
+        self.refreshlock.acquire()
+        try:
+            if(self.changelists is not None):
+                return 1, ""
+            return self.Query()
+        finally:
+            self.refreshlock.release()
+
+    def Refresh(self):
+        self.refreshlock.acquire()
+        try:
+            return self.Query()
+        finally:
+            self.refreshlock.release()
+
+    def Query(self):
+        info, err = workspace_info_cache.Get()
+        if(err):
+            return 0, err
+        if(not info.user or not self.client):
+            return 0, "Unexpected output from 'p4 info'."
+
+        records, errors = PerforceCommand(['changes', '-l', '-s', 'pending', '-u', info.user, '-c', self.client])
+        if(errors):
+            return 0, '\n'.join(errors)
+
+        changelists = {}
+        for record in records:
+            changelists[record['change']] = PendingChangelist(record['change'], record.get('desc', ''))
+
+        # one query counts the files of every changelist, another lists those with shelved files
+        openedfiles, errors = PerforceCommand(['opened', '-u', info.user, '-C', self.client])
+        for openedfile in openedfiles:
+            changelist = changelists.get(openedfile.get('change'))
+            if(changelist):
+                changelist.filecount += 1
+
+        shelved, errors = PerforceCommand(['changes', '-s', 'shelved', '-u', info.user, '-c', self.client])
+        for record in shelved:
+            changelist = changelists.get(record['change'])
+            if(changelist):
+                changelist.shelved = True
+
+        self.lock.acquire()
+        try:
+            self.changelists = changelists
+            self.timestamp = time.time()
+        finally:
+            self.lock.release()
+        return 1, "Found " + str(len(changelists)) + " pending changelists"
+
+    def RequestRefresh(self):
+        self.lock.acquire()
+        try:
+            if(self.refreshing):
+                return
+            self.refreshing = True
+        finally:
+            self.lock.release()
+
+        def refresh():
+            try:
+                self.Refresh()
+            finally:
+                self.refreshing = False
+        StartBackgroundThread(refresh)
+
+    def Add(self, in_number, in_description):
+        # keep the store in sync with the changelists the plugin creates itself
+        self.lock.acquire()
+        try:
+            if(self.changelists is not None):
+                self.changelists[in_number] = PendingChangelist(in_number, in_description)
+        finally:
+            self.lock.release()
+
+    def AppendToDescription(self, in_number, in_line):
+        self.lock.acquire()
+        try:
+            changelist = self.changelists and self.changelists.get(in_number)
+            if(changelist):
+                changelist.description = changelist.description.rstrip('\n') + '\n' + in_line + '\n'
+        finally:
+            self.lock.release()
+
+    def MoveFile(self, in_from, in_to):
+        self.lock.acquire()
+        try:
+            if(self.changelists is not None):
+                if(in_from in self.changelists):
+                    self.changelists[in_from].filecount = max(0, self.changelists[in_from].filecount - 1)
+                if(in_to in self.changelists):
+                    self.changelists[in_to].filecount += 1
+        finally:
+            self.lock.release()
+
+# one store per workspace, changelists belong to a single client
+pending_changelist_stores = {}
+pending_changelist_stores_lock = threading.Lock()
+
+def GetChangelistStore(in_folder = None):
+    client = None
+    if(in_folder):
+        client = workspace_registry.GetClient(in_folder)
+    if(client is None):
+        info, err = workspace_info_cache.Get()
+        if(not err):
+            client = info.client
+
+    pending_changelist_stores_lock.acquire()
+    try:
+        store = pending_changelist_stores.get(client)
+        if(store is None):
+            store = PendingChangelistStore(client)
+            pending_changelist_stores[client] = store
+        return store
+    finally:
+        pending_changelist_stores_lock.release()
+
+def InvalidateChangelistStores():
+    pending_changelist_stores_lock.acquire()
+    try:
+        pending_changelist_stores.clear()
+    finally:
+        pending_changelist_stores_lock.release()
+
+# load the changelists before a picker needs them
+sublime.set_timeout(lambda: StartBackgroundThread(lambda: GetChangelistStore().Refresh()), 1500)
+
+# Out of date section
+# Open views are polled with one batched fstat, views behind head or opened elsewhere are flagged in the status bar
+def GetOutOfDateStatus(in_state):
+    if(in_state is None):
+        return None
+
+    messages = []
+    if(in_state.IsOutOfDate() and in_state.headAction and in_state.headAction.find('delete') != -1):
+        messages.append("deleted at head")
+    elif(in_state.IsOutOfDate()):
+        messages.append("out of date (#" + str(in_state.haveRev) + " of #" + in_state.headRev + ")")
+    if(in_state.otherLock):
+        messages.append("locked by another user")
+    if(in_state.otherOpen):
+        messages.append("also opened by " + ', '.join(in_state.otherOpen))
+
+    if(not messages):
+        return None
+    return "Perforce: " + "; ".join(messages)
+
+def ShowOutOfDateStatus(in_view):
+    if(not in_view.file_name()):
+        return
+    status = GetOutOfDateStatus(file_state_index.Peek(in_view.file_name()))
+    if(status):
+        in_view.set_status('perforce_out_of_date', status)
+    else:
+        in_view.erase_status('perforce_out_of_date')
+
+def ShowOutOfDateStatusInAllViews():
+    for window in sublime.windows():
+        for view in window.views():
+            ShowOutOfDateStatus(view)
+
+class OutOfDatePollerThread(threading.Thread):
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.wakeup = threading.Event()
+        self.lastactivity = time.time()
+        self.lastpoll = 0
+        self.interval = None
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+
+    def Stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+    def NotifyActivity(self):
+        self.lastactivity = time.time()
+
+        # coming back from idle shouldn't wait for the long idle interval to expire
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        if(time.time() - self.lastpoll > perforce_settings.get('perforce_out_of_date_poll_interval')):
+            self.wakeup.set()
+
+    def GetInterval(self, duration, failed):
+        perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+        activeinterval = perforce_settings.get('perforce_out_of_date_poll_interval')
+        idleinterval = perforce_settings.get('perforce_out_of_date_idle_interval')
+
+        interval = activeinterval
+        if(time.time() - self.lastactivity > perforce_settings.get('perforce_out_of_date_idle_delay')):
+            interval = idleinterval
+
+        # a slow server is polled less often, at most a tenth of the time is spent waiting on it
+        interval = max(interval, duration * 10)
+
+        # an unreachable server is retried less and less often
+        if(failed and self.interval):
+            interval = max(interval, min(self.interval * 2, idleinterval))
+
+        return interval
+
+    def GetFiles(self):
+        # views can only be listed from the main thread
+        result = []
+        collected = threading.Event()
+        def collect():
+            try:
+                result.extend(GetOpenViewFiles())
+            finally:
+                collected.set()
+        sublime.set_timeout(collect, 0)
+        collected.wait(10)
+        return result
+
+    def Poll(self):
+        filenames = self.GetFiles()
+        if(not filenames):
+            return 0, True
+
+        start = time.time()
+        try:
+            failed = len(file_state_index.Refresh(filenames)) > 0
+        except OSError:
+            failed = True # p4 could not be started
+        duration = time.time() - start
+
+        sublime.set_timeout(ShowOutOfDateStatusInAllViews, 0)
+        return duration, failed
+
+    def run(self):
+        while(not self.stopped.isSet()):
+            duration = 0
+            failed = False
+            perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+            if(perforce_settings.get('perforce_out_of_date_check_enabled')):
+                duration, failed = self.Poll()
+                self.lastpoll = time.time()
+
+            self.interval = self.GetInterval(duration, failed)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+out_of_date_poller = OutOfDatePollerThread()
+
+class PerforceOutOfDateListener(sublime_plugin.EventListener):
+    def on_activated(self, view):
+        out_of_date_poller.NotifyActivity()
+        ShowOutOfDateStatus(view)
+
+    def on_modified(self, view):
+        out_of_date_poller.lastactivity = time.time()
+
+    def on_post_save(self, view):
+        ShowOutOfDateStatus(view)
+
+def unload_handler():
+    # Sublime Text calls this before reloading the plugin, the old poller must not keep running
+    out_of_date_poller.Stop()
+
+sublime.set_timeout(out_of_date_poller.start, 2000)
+
+# Depot revision cache section
+# Compressed copies of depot revisions keyed by depotFile#rev, so repeated diffs don't go back to the server
+class DepotRevisionCache(object):
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fetching = {}
+
+    def IsEnabled(self):
+        return sublime.load_settings('Perforce.sublime-settings').get('perforce_depot_cache_enabled')
+
+    def GetFolder(self, in_name):
+        folder = os.path.join(GetCacheDirectory(), in_name)
+        if(not os.path.isdir(folder)):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass # created by another thread
+        return folder
+
+    def GetKeyPath(self, in_depotfile, in_revision):
+        return os.path.join(self.GetFolder('keys'), hashlib.sha1(in_depotfile + '#' + in_revision).hexdigest())
+
+    def GetObjectPath(self, in_digest):
+        # objects are named after their content so identical revisions of branched files are stored once
+        return os.path.join(self.GetFolder('objects'), in_digest + '.gz')
+
+    def Lookup(self, in_depotfile, in_revision):
+        try:
+            keyfile = open(self.GetKeyPath(in_depotfile, in_revision), 'r')
+            try:
+                digest = keyfile.read().strip()
+            finally:
+                keyfile.close()
+        except IOError:
+            return None
+
+        objectpath = self.GetObjectPath(digest)
+        try:
+            # the modification time is the last use, eviction drops the least recently used objects
+            os.utime(objectpath, None)
+        except OSError:
+            return None # evicted
+        return objectpath
+
+    def Store(self, in_depotfile, in_revision, in_filename):
+        digest = hashlib.md5()
+        handle, temppath = tempfile.mkstemp(dir=self.GetFolder('incoming'))
+        os.close(handle)
+
+        source = open(in_filename, 'rb')
+        try:
+            target = gzip.open(temppath, 'wb')
+            try:
+                while(True):
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if(not chunk):
+                        break
+                    digest.update(chunk)
+                    target.write(chunk)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+        objectpath = self.GetObjectPath(digest.hexdigest().upper())
+        if(os.path.isfile(objectpath)):
+            os.unlink(temppath)
+        else:
+            os.rename(temppath, objectpath)
+
+        keyfile = open(self.GetKeyPath(in_depotfile, in_revision), 'w')
+        try:
+            keyfile.write(digest.hexdigest().upper())
+        finally:
+            keyfile.close()
+
+        return objectpath
+
+    def Fetch(self, in_depotfile, in_revision):
+        objectpath = self.Lookup(in_depotfile, in_revision)
+        perforce_stats.CountCache('depot revisions', objectpath is not None)
+        if(objectpath):
+            return objectpath, None
+
+        # only one thread prints a given revision, the others wait for it
+        key = in_depotfile + '#' + in_revision
+        self.lock.acquire()
+        try:
+            fetching = self.fetching.get(key)
+            if(fetching is None):
+                self.fetching[key] = threading.Event()
+        finally:
+            self.lock.release()
+
+        if(fetching is not None):
+            fetching.wait()
+            objectpath = self.Lookup(in_depotfile, in_revision)
+            if(objectpath):
+                return objectpath, None
+            return None, "Could not fetch " + key
+
+        try:
+            handle, temppath = tempfile.mkstemp()
+            os.close(handle)
+            try:
+                records, errors = PerforceCommand(['print', '-q', '-o', temppath, key])
+                if(errors):
+                    return None, '\n'.join(errors)
+                objectpath = self.Store(in_depotfile, in_revision, temppath)
+            finally:
+                os.unlink(temppath)
+        finally:
+            self.lock.acquire()
+            try:
+                self.fetching.pop(key).set()
+            finally:
+                self.lock.release()
+
+        self.Evict()
+        return objectpath, None
+
+    def ExtractTo(self, in_depotfile, in_revision, in_filename):
+        objectpath, err = self.Fetch(in_depotfile, in_revision)
+        if(err):
+            return 0, err
+
+        source = gzip.open(objectpath, 'rb')
+        try:
+            target = open(in_filename, 'wb')
+            try:
+                while(True):
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if(not chunk):
+                        break
+                    target.write(chunk)
+            finally:
+                target.close()
+        finally:
+            source.close()
+        return 1, in_filename
+
+    def Read(self, in_depotfile, in_revision):
+        objectpath, err = self.Fetch(in_depotfile, in_revision)
+        if(err):
+            return None, err
+
+        source = gzip.open(objectpath, 'rb')
+        try:
+            return source.read(), None
+        finally:
+            source.close()
+
+    def Evict(self):
+        limit = sublime.load_settings('Perforce.sublime-settings').get('perforce_depot_cache_size_mb')
+        if(not limit):
+            return
+
+        objects = []
+        totalsize = 0
+        folder = self.GetFolder('objects')
+        for name in os.listdir(folder):
+            try:
+                filestats = os.stat(os.path.join(folder, name))
+            except OSError:
+                continue
+            objects.append((filestats.st_mtime, filestats.st_size, name))
+            totalsize += filestats.st_size
+
+        # least recently used first, keys pointing to removed objects simply miss
+        objects.sort()
+        for mtime, size, name in objects:
+            if(totalsize <= limit * 1024 * 1024):
+                break
+            try:
+                os.unlink(os.path.join(folder, name))
+                totalsize -= size
+            except OSError:
+                pass
+
+    def GetHaveRevision(self, in_filename):
+        state = file_state_index.Get(in_filename)
+        if(state is None):
+            file_state_index.Refresh([in_filename])
+            state = file_state_index.Get(in_filename)
+
+        if(state is None or not state.depotFile or not state.haveRev):
+            return None, None
+        return state.depotFile, state.haveRev
+
+    def Prefetch(self, in_filenames):
+        if(not self.IsEnabled()):
+            return
+
+        def prefetch():
+            # the files the index doesn't know go through a single fstat, not one each
+            missing = [filename for filename in in_filenames if file_state_index.Get(filename) is None]
+            if(missing):
+                file_state_index.Refresh(missing)
+            for filename in in_filenames:
+                depotfile, revision = self.GetHaveRevision(filename)
+                if(depotfile):
+                    self.Fetch(depotfile, revision)
+
+        StartBackgroundThread(prefetch)
+
+depot_cache = DepotRevisionCache()
+
+# Asynchronous command section
+class PerforceRequest(object):
+    def __init__(self, description, function, args):
+        self.description = description
+        self.function = function
+        self.args = args
+        self.finished = threading.Event()
+        self.success = 0
+        self.message = "Perforce command did not complete."
+        self.entrypoint = perforce_stats.GetEntryPoint()
+
+    def Wait(self, timeout):
+        self.finished.wait(timeout)
+        return self.finished.isSet()
+
+    def Run(self):
+        perforce_stats.SetEntryPoint(self.entrypoint)
+        try:
+            self.success, self.message = self.function(*self.args)
+        except Exception, e:
+            self.success, self.message = 0, str(e)
+        perforce_stats.SetEntryPoint(None)
+        self.finished.set()
+
+    def LogResults(self):
+        LogResults(self.success, self.message)
+
+class PerforceCommandQueue(object):
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.worker = None
+
+    def Submit(self, description, function, *args):
+        request = PerforceRequest(description, function, args)
+
+        self.lock.acquire()
+        try:
+            if(self.worker is None or not self.worker.isAlive()):
+                self.worker = threading.Thread(target=self.ProcessRequests)
+                self.worker.setDaemon(True)
+                self.worker.start()
+        finally:
+            self.lock.release()
+
+        self.queue.put(request)
+        return request
+
+    def ProcessRequests(self):
+        # p4 runs here so the UI thread never waits on the server
+        while(True):
+            request = self.queue.get()
+
+            ShowStatus("Perforce: " + request.description + "...")
+            request.Run()
+            sublime.set_timeout(request.LogResults, 0)
+
+perforce_command_queue = PerforceCommandQueue()
+
+def RunInBackground(description, function, *args):
+    # for long running commands that must not hold up the checkout queue
+    request = PerforceRequest(description, function, args)
+
+    def run():
+        ShowStatus("Perforce: " + description + "...")
+        request.Run()
+        sublime.set_timeout(request.LogResults, 0)
+
+    StartBackgroundThread(run)
+    return request
+
 # Checkout section
 def Checkout(in_filename):
     folder_name, filename = os.path.split(in_filename)
@@ -222,26 +2330,230 @@ def Checkout(in_filename):
     if(IsFileWritable(in_filename)):
         return -1, "File is already writable."
 
+    if(connectivity_monitor.IsOffline()):
+        return OfflineCheckout(in_filename)
+
+    # a read-only file isn't opened whatever the index says, it may have been reverted behind our back
+    file_state_index.Forget(in_filename)
+
     # check out the file
-    return PerforceCommandOnFile("edit", folder_name, in_filename);
+    success, message = PerforceCommandOnFile("edit", folder_name, in_filename);
+    if(success):
+        # the state was forgotten above, the prefetch queries it again along with the have revision
+        if(depot_cache.IsEnabled()):
+            depot_cache.Prefetch([in_filename])
+        else:
+            file_state_index.RequestRefresh([in_filename])
+    return success, message
+
+def CheckoutFiles(in_filenames):
+    # every file of a workspace goes through a single p4 edit, the records tell us which ones were opened
+    records = []
+    errors = []
+    for client, filenames in GroupFilesByWorkspace(in_filenames).items():
+        clientrecords, clienterrors = PerforceCommand(GetClientArguments(client) + ['-x', '-', 'edit'], '\n'.join(filenames) + '\n')
+        records.extend(clientrecords)
+        errors.extend(clienterrors)
+
+    opened = {}
+    for record in records:
+        if('clientFile' in record):
+            opened[os.path.normcase(record['clientFile'])] = record.GetMessage()
+
+    results = {}
+    for filename in in_filenames:
+        key = os.path.normcase(filename)
+        if(key in opened):
+            results[filename] = (1, opened[key])
+            file_state_index.Update(filename, action='edit', change='default')
+            continue
+
+        message = "Could not open file for edit."
+        for line in errors:
+            if(os.path.normcase(line).find(key) != -1):
+                message = line.strip()
+                break
+        results[filename] = (0, message)
+
+    depot_cache.Prefetch([filename for filename in in_filenames if results[filename][0] == 1])
+    return results
   
+# Keeps at most one checkout in flight per file and remembers the outcome so keystrokes don't hit the disk or the server
+class CheckoutStateTracker(object):
+    UNKNOWN = 'unknown'
+    CHECKING_OUT = 'checking-out'
+    OPENED = 'opened'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.states = {}
+        self.requests = {}
+
+    def GetKey(self, in_filename):
+        return os.path.normcase(os.path.abspath(in_filename))
+
+    def GetState(self, in_filename):
+        return self.states.get(self.GetKey(in_filename), self.UNKNOWN)
+
+    def Forget(self, in_filename):
+        key = self.GetKey(in_filename)
+        self.lock.acquire()
+        try:
+            self.states.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def RequestCheckout(self, in_filename, in_retry_failed = False):
+        key = self.GetKey(in_filename)
+
+        self.lock.acquire()
+        try:
+            state = self.states.get(key, self.UNKNOWN)
+            perforce_stats.CountCache('checkout states', state != self.UNKNOWN)
+            if(state == self.CHECKING_OUT):
+                return self.requests[key]
+            if(state == self.OPENED or (state == self.FAILED and not in_retry_failed)):
+                return None
+
+            self.states[key] = self.CHECKING_OUT
+            request = perforce_command_queue.Submit("checking out " + os.path.basename(in_filename), self.Checkout, key, in_filename)
+            self.requests[key] = request
+            return request
+        finally:
+            self.lock.release()
+
+    def RequestBatchCheckout(self, in_filenames):
+        self.lock.acquire()
+        try:
+            filenames = []
+            for filename in in_filenames:
+                state = self.states.get(self.GetKey(filename), self.UNKNOWN)
+                if(state == self.UNKNOWN or state == self.FAILED):
+                    filenames.append(filename)
+
+            if(not filenames):
+                return None
+
+            request = perforce_command_queue.Submit("checking out " + str(len(filenames)) + " files", self.CheckoutBatch, filenames)
+            for filename in filenames:
+                key = self.GetKey(filename)
+                self.states[key] = self.CHECKING_OUT
+                self.requests[key] = request
+            return request
+        finally:
+            self.lock.release()
+
+    def CheckoutBatch(self, in_filenames):
+        results = CheckoutFiles(in_filenames)
+
+        self.lock.acquire()
+        try:
+            failures = []
+            for filename in in_filenames:
+                key = self.GetKey(filename)
+                success, message = results[filename]
+                if(success == 1):
+                    self.states[key] = self.OPENED
+                else:
+                    self.states[key] = self.FAILED
+                    failures.append(message)
+                self.requests.pop(key, None)
+        finally:
+            self.lock.release()
+
+        if(failures):
+            return 0, str(len(in_filenames) - len(failures)) + " of " + str(len(in_filenames)) + " files opened for edit\n" + '\n'.join(failures)
+        return 1, str(len(in_filenames)) + " files opened for edit"
+
+    def Checkout(self, in_key, in_filename):
+        success, message = Checkout(in_filename)
+
+        self.lock.acquire()
+        try:
+            if(success == 1 or (os.path.isfile(in_filename) and IsFileWritable(in_filename))):
+                self.states[in_key] = self.OPENED
+            else:
+                self.states[in_key] = self.FAILED
+            self.requests.pop(in_key, None)
+        finally:
+            self.lock.release()
+
+        return success, message
+
+checkout_state_tracker = CheckoutStateTracker()
+
+def GetModifiedReadOnlyFiles():
+    filenames = []
+    for window in sublime.windows():
+        for view in window.views():
+            filename = view.file_name()
+            if(not filename or not view.is_dirty() or filename in filenames):
+                continue
+            if(checkout_state_tracker.GetState(filename) in (CheckoutStateTracker.OPENED, CheckoutStateTracker.CHECKING_OUT)):
+                continue
+            if(not os.path.isfile(filename) or IsFileWritable(filename)):
+                continue
+
+            folder_name, name = os.path.split(filename)
+            if(IsFileInDepot(folder_name, name) == 1):
+                filenames.append(filename)
+    return filenames
+
+def CheckoutModifiedFiles():
+    filenames = GetModifiedReadOnlyFiles()
+    if(not filenames):
+        return None
+    return checkout_state_tracker.RequestBatchCheckout(filenames)
+
 class PerforceAutoCheckout(sublime_plugin.EventListener):  
+    pendingModifications = {}
+
+    def on_load(self, view):
+        if(view.file_name()):
+            checkout_state_tracker.Forget(view.file_name())
+
+    def on_close(self, view):
+        self.pendingModifications.pop(view.id(), None)
+        if(view.file_name()):
+            checkout_state_tracker.Forget(view.file_name())
+
     def on_modified(self, view):
         if(not view.file_name()):
             return
 
-        if(IsFileWritable(view.file_name())):
-            return
-
         perforce_settings = sublime.load_settings('Perforce.sublime-settings')
 
         # check if this part of the plugin is enabled
         if(not perforce_settings.get('perforce_auto_checkout') or not perforce_settings.get('perforce_auto_checkout_on_modified')):
             return
-              
+
+        # once the file is known to be opened there is nothing left to do, not even a stat
+        if(checkout_state_tracker.GetState(view.file_name()) != CheckoutStateTracker.UNKNOWN):
+            return
+
+        # wait for the typing to settle before looking at the file
+        generation = self.pendingModifications.get(view.id(), 0) + 1
+        self.pendingModifications[view.id()] = generation
+        sublime.set_timeout(lambda: self.on_modified_settled(view, generation), perforce_settings.get('perforce_auto_checkout_debounce_delay'))
+
+    def on_modified_settled(self, view, generation):
+        if(self.pendingModifications.get(view.id()) != generation):
+            return
+        del self.pendingModifications[view.id()]
+
+        if(not view.file_name() or not os.path.isfile(view.file_name())):
+            return
+
+        if(IsFileWritable(view.file_name())):
+            return
+
         if(view.is_dirty()):
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+            # a find and replace across files dirties many views at once, pick them all up in one p4 edit
+            if(sublime.load_settings('Perforce.sublime-settings').get('perforce_auto_checkout_batch')):
+                CheckoutModifiedFiles()
+            else:
+                checkout_state_tracker.RequestCheckout(view.file_name())
 
     def on_pre_save(self, view):
         perforce_settings = sublime.load_settings('Perforce.sublime-settings')
@@ -249,23 +2561,206 @@ class PerforceAutoCheckout(sublime_plugin.EventListener):
         # check if this part of the plugin is enabled
         if(not perforce_settings.get('perforce_auto_checkout') or not perforce_settings.get('perforce_auto_checkout_on_save')):
             return
+
+        # new files and files that are already writable can be saved right away
+        if(not os.path.isfile(view.file_name()) or IsFileWritable(view.file_name())):
+            return
+
+        # the file went back to read-only behind our back (reverted outside of Sublime), check it out again
+        if(checkout_state_tracker.GetState(view.file_name()) == CheckoutStateTracker.OPENED):
+            checkout_state_tracker.Forget(view.file_name())
               
         if(view.is_dirty()):
-            success, message = Checkout(view.file_name())
-            LogResults(success, message);
+            request = checkout_state_tracker.RequestCheckout(view.file_name(), True)
+
+            # hold the save until the file is writable, but never longer than the configured timeout
+            if(request and not request.Wait(perforce_settings.get('perforce_save_wait_timeout'))):
+                WarnUser("Checkout of " + os.path.basename(view.file_name()) + " is still pending, saving anyway")
 
 class PerforceCheckoutCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         if(self.view.file_name()):
-            success, message = Checkout(self.view.file_name())
-            LogResults(success, message)
+            checkout_state_tracker.Forget(self.view.file_name())
+            checkout_state_tracker.RequestCheckout(self.view.file_name())
         else:
             WarnUser("View does not contain a file")
 
+class PerforceCheckoutAllModifiedFilesCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(not CheckoutModifiedFiles()):
+            WarnUser("No modified read-only files to check out")
+
+# Ignore section
+# P4IGNORE files and the plugin's own patterns are matched locally, ignored files never reach p4 add
+def TranslateIgnorePattern(in_pattern):
+    # ** and ... cross folders, * and ? stay within a name, a/**/b also matches a/b
+    expression = ''
+    index = 0
+    while(index < len(in_pattern)):
+        if(in_pattern.startswith('**/', index) and (index == 0 or in_pattern[index - 1] == '/')):
+            expression += '(?:.*/)?'
+            index += 3
+        elif(in_pattern.startswith('**', index)):
+            expression += '.*'
+            index += 2
+        elif(in_pattern.startswith('...', index)):
+            expression += '.*'
+            index += 3
+        elif(in_pattern[index] == '*'):
+            expression += '[^/]*'
+            index += 1
+        elif(in_pattern[index] == '?'):
+            expression += '[^/]'
+            index += 1
+        else:
+            expression += re.escape(in_pattern[index])
+            index += 1
+    return expression
+
+def CompileIgnoreRules(in_lines):
+    # [(regex, negated)] matched against paths relative to the folder of the ignore file, the last match wins
+    rules = []
+    for line in in_lines:
+        line = line.strip()
+        if(not line or line.startswith('#')):
+            continue
+        negated = line.startswith('!')
+        if(negated):
+            line = line[1:]
+        rooted = line.startswith('/')
+        directory = line.endswith('/')
+        line = line.rstrip('/').lstrip('/')
+        if(not line):
+            continue
+
+        if(rooted or line.find('/') != -1 or line.startswith('**') or line.startswith('...')):
+            prefix = '^' # rooted at the folder of the ignore file
+        else:
+            prefix = '^(?:.*/)?' # a name, at any depth
+        if(directory):
+            suffix = '/.*$'
+        else:
+            suffix = '(?:/.*)?$'
+        rules.append((re.compile(prefix + TranslateIgnorePattern(line) + suffix, re.IGNORECASE if sys.platform == 'win32' else 0), negated))
+    return rules
+
+def MatchIgnoreRules(in_rules, in_relativepath, in_ignored):
+    for expression, negated in in_rules:
+        if(expression.match(in_relativepath)):
+            in_ignored = not negated
+    return in_ignored
+
+class IgnoreMatcher(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {} # ignore file -> (mtime, rules)
+        self.patterns = None
+        self.patternrules = []
+        self.names = None
+        self.nameskey = None
+
+    def GetIgnoreNames(self):
+        # P4IGNORE can list several names, absolute ones apply everywhere
+        key = workspace_info_cache.GetEnvironmentKey()
+        if(key == self.nameskey):
+            return self.names
+
+        value = os.environ.get('P4IGNORE')
+        if(value is None):
+            result, err = perforce_runner.Execute(['set', '-q', 'P4IGNORE'])
+            value = result.strip().partition('=')[2]
+
+        self.names = [name.strip() for name in re.split('[;,]', value or '') if name.strip()]
+        self.nameskey = key
+        return self.names
+
+    def GetFileRules(self, in_filename):
+        # an ignore file is parsed again only when it changes
+        try:
+            mtime = os.path.getmtime(in_filename)
+        except OSError:
+            return None
+
+        self.lock.acquire()
+        try:
+            entry = self.files.get(in_filename)
+            perforce_stats.CountCache('ignore files', entry is not None and entry[0] == mtime)
+            if(entry is not None and entry[0] == mtime):
+                return entry[1]
+        finally:
+            self.lock.release()
+
+        try:
+            ignorefile = open(in_filename, 'r')
+            try:
+                rules = CompileIgnoreRules(ignorefile.read().splitlines())
+            finally:
+                ignorefile.close()
+        except IOError:
+            return None
+
+        self.lock.acquire()
+        try:
+            self.files[in_filename] = (mtime, rules)
+        finally:
+            self.lock.release()
+        return rules
+
+    def GetPatternRules(self):
+        patterns = sublime.load_settings('Perforce.sublime-settings').get('perforce_ignore_patterns') or []
+        if(patterns != self.patterns):
+            self.patternrules = CompileIgnoreRules(patterns)
+            self.patterns = list(patterns)
+        return self.patternrules
+
+    def IsIgnored(self, in_filename):
+        filename = os.path.abspath(in_filename)
+        fullpath = filename.replace(os.sep, '/').lstrip('/')
+        ignored = MatchIgnoreRules(self.GetPatternRules(), fullpath, False)
+
+        names = self.GetIgnoreNames()
+        if(not names):
+            return ignored
+
+        # the outermost ignore files apply first, the ones closer to the file can override them
+        folders = []
+        folder = os.path.dirname(filename)
+        while(True):
+            folders.insert(0, folder)
+            parent = os.path.dirname(folder)
+            if(parent == folder):
+                break
+            folder = parent
+
+        for name in names:
+            if(os.path.isabs(name)):
+                rules = self.GetFileRules(name)
+                if(rules):
+                    ignored = MatchIgnoreRules(rules, fullpath, ignored)
+        for folder in folders:
+            for name in names:
+                if(os.path.isabs(name)):
+                    continue
+                rules = self.GetFileRules(os.path.join(folder, name))
+                if(rules):
+                    ignored = MatchIgnoreRules(rules, os.path.relpath(filename, folder).replace(os.sep, '/'), ignored)
+        return ignored
+
+ignore_matcher = IgnoreMatcher()
+
+def IsFileIgnored(in_filename):
+    return ignore_matcher.IsIgnored(in_filename)
+
 # Add section
 def Add(in_folder, in_filename):
+    if(connectivity_monitor.IsOffline()):
+        return OfflineAdd(os.path.join(in_folder, in_filename))
+
     # add the file
-    return PerforceCommandOnFile("add", in_folder, in_filename);
+    success, message = PerforceCommandOnFile("add", in_folder, in_filename);
+    if(success):
+        file_state_index.Update(os.path.join(in_folder, in_filename), action='add', change='default')
+    return success, message
 
 class PerforceAutoAdd(sublime_plugin.EventListener):
     preSaveIsFileInDepot = 0
@@ -279,61 +2774,148 @@ class PerforceAutoAdd(sublime_plugin.EventListener):
             WarnUser("Auto Add disabled")
             return
 
+        # build outputs and temporary files are turned down here instead of by the server
+        if(IsFileIgnored(view.file_name())):
+            return
+
         folder_name, filename = os.path.split(view.file_name())
         self.preSaveIsFileInDepot = IsFileInDepot(folder_name, filename)
 
     def on_post_save(self, view):
         if(self.preSaveIsFileInDepot == -1):
             folder_name, filename = os.path.split(view.file_name())
-            success, message = Add(folder_name, filename)
-            LogResults(success, message)
+            perforce_command_queue.Submit("adding " + filename, Add, folder_name, filename)
 
 class PerforceAddCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         if(self.view.file_name()):
             folder_name, filename = os.path.split(self.view.file_name())
 
-            if(IsFileInDepot(folder_name, filename)):
-                success, message = Add(folder_name, filename)
+            if(IsFileIgnored(self.view.file_name())):
+                LogResults(0, filename + " is ignored by P4IGNORE or perforce_ignore_patterns.")
+            elif(IsFileInDepot(folder_name, filename)):
+                perforce_command_queue.Submit("adding " + filename, Add, folder_name, filename)
             else:
-                success = 0
-                message = "File is not under the client root."
-
-            LogResults(success, message)
+                LogResults(0, "File is not under the client root.")
         else:
             WarnUser("View does not contain a file")
 
 # Rename section
-def Rename(in_filename, in_newname):
-    command = 'p4 integrate -d -t -Di -f "' + in_filename + '" "' + in_newname + '"'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
-
-    if(err):
-        return 0, err.strip()
-    
-    command = 'p4 delete "' + in_filename + '" "' + in_newname + '"'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
+# Files and folders are moved with p4 move, every pair goes through a single p4 -x - per workspace
+def GetMoveArguments(in_filename, in_newname):
+    # a folder moves with every file p4 knows under it
+    if(os.path.isdir(in_filename)):
+        return os.path.join(in_filename, '...'), os.path.join(in_newname, '...')
+    return in_filename, in_newname
+
+def RenameFiles(in_moves):
+    if(connectivity_monitor.IsOffline()):
+        messages = []
+        for filename, newname in in_moves:
+            success, message = OfflineRename(filename, newname)
+            messages.append(message)
+        return 1, '\n'.join(messages)
+
+    sources = []
+    pairs = []
+    for filename, newname in in_moves:
+        source, target = GetMoveArguments(filename, newname)
+        sources.append(source)
+        pairs.extend([source, target])
+
+    # p4 move wants its sources opened, those already opened for edit or add only produce a warning
+    errors = []
+    for client, filenames in GroupFilesByWorkspace(sources).items():
+        for record in PerforceRecords(GetClientArguments(client) + ['-x', '-', 'edit'], '\n'.join(filenames) + '\n'):
+            if(record.IsError() and int(record.get('severity', E_WARN + 1)) > E_WARN):
+                errors.append(record.GetMessage())
+    if(errors):
+        return 0, '\n'.join(errors).strip()
+
+    records, errors = PerforceBatch(['-b', '2', 'move'], pairs, 2)
+
+    for filename, newname in in_moves:
+        if(os.path.isdir(newname)):
+            file_state_index.ForgetFolder(filename)
+        else:
+            file_state_index.Forget(filename)
+    InvalidateChangelistStores()
 
-    if(not err):
-        return 1, result.strip()
+    if(not errors):
+        return 1, FormatRecords(records).strip()
     else:
-        return 0, err.strip()
+        return 0, '\n'.join(errors).strip()
+
+def Rename(in_filename, in_newname):
+    return RenameFiles([(in_filename, in_newname)])
+
+def GetRenamedPath(in_filename, in_moves):
+    key = NormalizePath(in_filename)
+    for filename, newname in in_moves:
+        source = NormalizePath(filename)
+        if(key == source):
+            return newname
+        if(key.startswith(os.path.join(source, ''))):
+            return os.path.join(newname, in_filename[len(filename):].lstrip('\\/'))
+    return None
+
+def RetargetViews(in_moves):
+    # every view showing a moved file follows it, in the same group and at the same position
+    skipped = []
+    for window in sublime.windows():
+        for view in window.views():
+            if(not view.file_name()):
+                continue
+            newname = GetRenamedPath(view.file_name(), in_moves)
+            if(newname is None or not os.path.isfile(newname)):
+                continue
+
+            if(hasattr(view, 'retarget')):
+                view.retarget(newname)
+                continue
+            if(view.is_dirty()):
+                skipped.append(view.file_name())
+                continue
+
+            group, index = window.get_view_index(view)
+            row, col = view.rowcol(view.sel()[0].begin()) if len(view.sel()) else (0, 0)
+            window.focus_view(view)
+            window.run_command('close')
+            newview = window.open_file(newname + ':' + str(row + 1) + ':' + str(col + 1), sublime.ENCODED_POSITION)
+            window.set_view_index(newview, group, index)
+
+    for filename in skipped:
+        WarnUser(filename + " has unsaved changes, save it under its new name.")
 
 class PerforceRenameCommand(sublime_plugin.WindowCommand):
-    def run(self):
-        # Get the description
-        self.window.show_input_panel('New File Name', self.window.active_view().file_name(),
-            self.on_done, self.on_change, self.on_cancel)
+    def run(self, paths = None):
+        # from the side bar, several files or folders move together into another folder
+        self.paths = paths or (self.window.active_view() and [self.window.active_view().file_name()]) or []
+        self.paths = [path for path in self.paths if path]
+        if(not self.paths):
+            WarnUser("View does not contain a file")
+            return
+
+        if(len(self.paths) == 1):
+            self.window.show_input_panel('New Name', self.paths[0], self.on_done, self.on_change, self.on_cancel)
+        else:
+            self.window.show_input_panel('Move ' + str(len(self.paths)) + ' Items To Folder', os.path.dirname(self.paths[0]),
+                self.on_done, self.on_change, self.on_cancel)
 
     def on_done(self, input):
-        success, message = Rename(self.window.active_view().file_name(), input)
-        if(success):
-            self.window.run_command('close')
-            self.window.open_file(input)
+        if(len(self.paths) == 1):
+            moves = [(self.paths[0], input)]
+        else:
+            moves = [(path, os.path.join(input, os.path.basename(path.rstrip('\\/')))) for path in self.paths]
 
-        LogResults(success, message)
+        request = RunInBackground("moving " + str(len(moves)) + " items", RenameFiles, moves)
+
+        def retarget():
+            if(not request.finished.isSet()):
+                sublime.set_timeout(retarget, 100)
+            elif(request.success):
+                RetargetViews(moves)
+        sublime.set_timeout(retarget, 100)
 
     def on_change(self, input):
         pass
@@ -343,7 +2925,11 @@ class PerforceRenameCommand(sublime_plugin.WindowCommand):
 
 # Delete section
 def Delete(in_folder, in_filename):
+    if(connectivity_monitor.IsOffline()):
+        return OfflineDelete(os.path.join(in_folder, in_filename))
+
     success, message = PerforceCommandOnFile("delete", in_folder, in_filename)
+    file_state_index.Forget(os.path.join(in_folder, in_filename))
     if(success):
         # test if the file is deleted
         if(os.path.isfile(os.path.join(in_folder, in_filename))):
@@ -370,8 +2956,19 @@ class PerforceDeleteCommand(sublime_plugin.WindowCommand):
 
 # Revert section
 def Revert(in_folder, in_filename):
+    if(connectivity_monitor.IsOffline()):
+        return OfflineRevert(os.path.join(in_folder, in_filename))
+
+    # the index may not know about a checkout made outside of Sublime, p4 has the final say
+    state = file_state_index.Get(os.path.join(in_folder, in_filename))
+
     # revert the file
-    return PerforceCommandOnFile("revert", in_folder, in_filename);
+    success, message = PerforceCommandOnFile("revert", in_folder, in_filename);
+    if(success):
+        if(state is not None):
+            GetChangelistStore(in_folder).MoveFile(state.change, None)
+        file_state_index.Update(os.path.join(in_folder, in_filename), action=None, change=None)
+    return success, message
 
 class PerforceRevertCommand(sublime_plugin.TextCommand):
     def run_(self, args): # revert cannot be called when an Edit object exists, manually handle the run routine
@@ -380,6 +2977,7 @@ class PerforceRevertCommand(sublime_plugin.TextCommand):
 
             if(IsFileInDepot(folder_name, filename)):
                 success, message = Revert(folder_name, filename)
+                checkout_state_tracker.Forget(self.view.file_name())
                 if(success): # the file was properly reverted, ask Sublime Text to refresh the view
                     self.view.run_command('revert');
             else:
@@ -410,30 +3008,567 @@ class PerforceDiffCommand(sublime_plugin.TextCommand):
         else:
             WarnUser("View does not contain a file")
                     
-# Graphical Diff With Depot section
-def GraphicalDiffWithDepot(self, in_folder, in_filename):
+# Sync section
+# p4 sync streams its records into an output panel, the views of updated files are reloaded when it is done
+def GetSyncArguments():
     perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+    threads = perforce_settings.get('perforce_sync_parallel_threads')
+    batch = perforce_settings.get('perforce_sync_parallel_batch')
+
+    arguments = ['sync']
+    if(threads and threads > 1):
+        parallel = 'threads=' + str(threads)
+        if(batch):
+            parallel += ',batch=' + str(batch)
+        arguments.append('--parallel=' + parallel)
+    return arguments
+
+def FormatSyncRecord(in_record):
+    if(in_record.GetCode() != 'stat' or not 'depotFile' in in_record):
+        return in_record.GetMessage()
+    return in_record['depotFile'] + '#' + in_record.get('rev', '') + ' - ' + in_record.get('action', 'updated') + ' ' + in_record.get('clientFile', '')
+
+class SyncThread(threading.Thread):
+    current = None
+
+    def __init__(self, window, description, paths, folder):
+        self.window = window
+        self.description = description
+        self.paths = paths
+        self.folder = folder
+        self.cancellation = PerforceCancellation()
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushscheduled = False
+        self.synced = {}
+        self.summary = ''
+        self.panel = ShowOutputPanel(window, 'perforce_sync', "Syncing " + description + "...\n")
+        threading.Thread.__init__(self)
 
-    success, content = PerforceCommandOnFile("print", in_folder, in_filename)
-    if(not success):
-        return 0, content
+    def Output(self, line):
+        # lines are handed to the UI thread in batches, a large sync must not flood it
+        self.lock.acquire()
+        try:
+            self.pending.append(line + '\n')
+            if(self.flushscheduled):
+                return
+            self.flushscheduled = True
+        finally:
+            self.lock.release()
+        sublime.set_timeout(self.Flush, 100)
+
+    def Flush(self):
+        self.lock.acquire()
+        try:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.flushscheduled = False
+        finally:
+            self.lock.release()
+        if(text):
+            AppendToOutputPanel(self.panel, text)
 
-    # Create a temporary file to hold the depot version
-    depotFileName = "depot"+in_filename
-    tmp_file = open(os.path.join(tempfile.gettempdir(), depotFileName), 'w')
+    def run(self):
+        count = 0
+        errors = 0
+        for record in PerforceRecords(GetSyncArguments() + self.paths, None, self.folder, self.cancellation):
+            if(record.GetCode() == 'error'):
+                # "file(s) up-to-date." is only a warning
+                if(record.IsError() and int(record.get('severity', E_WARN + 1)) > E_WARN and not self.cancellation.IsCancelled()):
+                    errors += 1
+                self.Output(record.GetMessage())
+                continue
+
+            if('clientFile' in record):
+                self.synced[NormalizePath(record['clientFile'])] = record
+                count += 1
+            self.Output(FormatSyncRecord(record))
+
+        self.summary = "Synced " + str(count) + " files"
+        if(errors):
+            self.summary += ", " + str(errors) + " errors"
+        if(self.cancellation.IsCancelled()):
+            self.summary += ", cancelled"
+        sublime.set_timeout(self.Finish, 0)
+
+    def Finish(self):
+        self.Flush()
+
+        for record in self.synced.values():
+            if(record.get('action') == 'deleted'):
+                file_state_index.Update(record['clientFile'], haveRev=None)
+            else:
+                file_state_index.Update(record['clientFile'], haveRev=record.get('rev'))
+
+        # reload the views of updated files, unless they have changes of their own
+        skipped = []
+        for window in sublime.windows():
+            for view in window.views():
+                if(not view.file_name() or not NormalizePath(view.file_name()) in self.synced):
+                    continue
+                if(view.is_dirty()):
+                    skipped.append(view.file_name())
+                else:
+                    view.run_command('revert')
+                    ShowOutOfDateStatus(view)
+
+        for filename in skipped:
+            AppendToOutputPanel(self.panel, filename + " was not reloaded, it has unsaved changes\n")
+        AppendToOutputPanel(self.panel, self.summary + "\n")
+        LogResults(1, self.summary)
+        ShowStatus("Perforce: " + self.summary)
+
+def StartSync(window, description, paths, folder):
+    if(SyncThread.current and SyncThread.current.isAlive()):
+        WarnUser("A sync is already running, cancel it first.")
+        return
+    SyncThread.current = SyncThread(window, description, paths, folder)
+    SyncThread.current.start()
+
+class PerforceSyncFileCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if(not self.view.file_name()):
+            WarnUser("View does not contain a file")
+            return
+        StartSync(self.view.window(), os.path.basename(self.view.file_name()), [self.view.file_name()], os.path.dirname(self.view.file_name()))
+
+class PerforceSyncFolderCommand(sublime_plugin.WindowCommand):
+    def run(self, dirs = None):
+        folder = dirs and dirs[0] or GetWindowFolder(self.window)
+        if(not folder):
+            WarnUser("No folder to sync")
+            return
+        StartSync(self.window, folder, [os.path.join(folder, '...')], folder)
 
-    # Remove the first two lines of content
-    linebyline = content.splitlines();
-    content=perforce_settings.get('perforce_end_line_separator').join(linebyline[1:]);
+class PerforceSyncWorkspaceCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        # without a file argument p4 syncs the whole client of the folder
+        folder = GetWindowFolder(self.window)
+        StartSync(self.window, "workspace", [], folder)
 
+class PerforceCancelSyncCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        if(SyncThread.current and SyncThread.current.isAlive()):
+            SyncThread.current.cancellation.Cancel()
+        else:
+            WarnUser("No sync is running.")
+
+# Reconcile section
+# Local files are hashed against the digests the server keeps, only the files that really differ go through p4 reconcile
+RECONCILE_FIELDS = 'clientFile,depotFile,headAction,headType,haveRev,action,digest'
+
+TEXT_FILE_TYPES = ('text', 'xtext', 'ctext', 'cxtext', 'ltext', 'xltext', 'unicode', 'xunicode', 'utf8', 'xutf8')
+
+def CanCompareDigest(in_filetype):
+    # the server digest covers the normalized content, keyword expansion and utf16 change it on the client
+    if(not in_filetype):
+        return False
+    base, separator, modifiers = in_filetype.partition('+')
+    if(base in ('symlink', 'utf16', 'xutf16') or base.startswith('k') or modifiers.find('k') != -1):
+        return False
+    return True
+
+def IsTextFileType(in_filetype):
+    return in_filetype.partition('+')[0] in TEXT_FILE_TYPES
+
+def ComputeFileDigest(in_filename, in_text):
+    # text revisions are stored with unix line endings, local ones may have the platform's
+    digest = hashlib.md5()
+    localfile = open(in_filename, 'rb')
     try:
-        tmp_file.write(content)
+        carry = ''
+        while(True):
+            chunk = localfile.read(DepotRevisionCache.CHUNK_SIZE * 16)
+            if(not chunk):
+                break
+            if(in_text):
+                chunk = carry + chunk
+                carry = ''
+                if(chunk.endswith('\r')):
+                    carry = '\r'
+                    chunk = chunk[:-1]
+                chunk = chunk.replace('\r\n', '\n')
+            digest.update(chunk)
+        digest.update(carry)
     finally:
-        tmp_file.close()
+        localfile.close()
+    return digest.hexdigest().upper()
+
+class LocalDigestIndex(object):
+    # digests of local files keyed by path, reused as long as their mtime and size don't change
+    def __init__(self, in_folder):
+        self.path = os.path.join(GetCacheDirectory(), 'digests', hashlib.sha1(NormalizePath(in_folder)).hexdigest() + '.json')
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        try:
+            indexfile = open(self.path, 'r')
+            try:
+                self.entries = json.load(indexfile)
+            finally:
+                indexfile.close()
+        except (IOError, ValueError):
+            pass
+
+    def Lookup(self, in_filename, in_stat, in_text):
+        key = NormalizePath(in_filename)
+        entry = self.entries.get(key)
+        if(entry and entry[0] == in_stat.st_mtime and entry[1] == in_stat.st_size and entry[2] == in_text):
+            self.used[key] = entry
+            self.hits += 1
+            return entry[3]
+        return None
+
+    def Store(self, in_filename, in_stat, in_text, in_digest):
+        self.lock.acquire()
+        try:
+            self.used[NormalizePath(in_filename)] = [in_stat.st_mtime, in_stat.st_size, in_text, in_digest]
+        finally:
+            self.lock.release()
+
+    def Save(self):
+        # only the files seen by this reconcile are kept, deleted ones drop out of the index
+        if(not os.path.isdir(os.path.dirname(self.path))):
+            os.makedirs(os.path.dirname(self.path))
+        indexfile = open(self.path + '.tmp', 'w')
+        try:
+            json.dump(self.used, indexfile)
+        finally:
+            indexfile.close()
+        if(os.path.isfile(self.path)):
+            os.remove(self.path)
+        os.rename(self.path + '.tmp', self.path)
+
+def ComputeDigests(in_files, in_index, in_cancellation):
+    # hashlib releases the GIL on large buffers, so a few threads keep the disks and the cores busy
+    threadcount = sublime.load_settings('Perforce.sublime-settings').get('perforce_reconcile_hash_threads') or 1
+    queue = Queue.Queue()
+    for item in in_files:
+        queue.put(item)
+    digests = {}
+
+    def work():
+        while(not in_cancellation.IsCancelled()):
+            try:
+                filename, filestat, text = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                digest = ComputeFileDigest(filename, text)
+            except (IOError, OSError):
+                continue
+            in_index.Store(filename, filestat, text, digest)
+            digests[filename] = digest
+
+    workers = [threading.Thread(target=work) for index in range(min(threadcount, len(in_files)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return digests
+
+def ListLocalFiles(in_folder):
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(in_folder):
+        for filename in filenames:
+            filename = os.path.join(dirpath, filename)
+            try:
+                filestat = os.lstat(filename)
+            except OSError:
+                continue
+            if(stat.S_ISREG(filestat.st_mode)):
+                files[NormalizePath(filename)] = (filename, filestat)
+    return files
+
+def FindChangedFiles(in_folder, in_cancellation):
+    # returns the local paths p4 reconcile should look at, how many files didn't need hashing and the fstat error if any
+    localfiles = ListLocalFiles(in_folder)
+
+    candidates = []
+    tohash = []
+    expected = {}
+    index = LocalDigestIndex(in_folder)
+    # the digests have to be the ones of the revisions in the workspace, not the ones at head
+    records = PerforceRecords(['fstat', '-Ol', '-T', RECONCILE_FIELDS, os.path.join(in_folder, '...#have')], None, in_folder, in_cancellation)
+    for record in records:
+        if(record.IsError() and int(record.get('severity', E_WARN + 1)) > E_WARN):
+            # without the depot side every local file would look new, reconciling them would open them all for add
+            return [], 0, record.GetMessage()
+        if(record.GetCode() != 'stat' or not 'clientFile' in record):
+            continue
+        key = NormalizePath(record['clientFile'])
+        local = localfiles.pop(key, None)
+        if('action' in record):
+            continue # already opened, p4 knows about it
+        if(not record.get('haveRev') or record.get('headAction', '').find('delete') != -1):
+            if(local):
+                candidates.append(local[0]) # not synced or deleted at head, but present locally
+            continue
+        if(local is None):
+            candidates.append(record['clientFile']) # deleted locally
+            continue
+
+        filetype = record.get('headType', '')
+        if(not record.get('digest') or not CanCompareDigest(filetype)):
+            candidates.append(local[0])
+            continue
+        filename, filestat = local
+        text = IsTextFileType(filetype)
+        expected[filename] = record['digest'].upper()
+        digest = index.Lookup(filename, filestat, text)
+        if(digest is None):
+            tohash.append((filename, filestat, text))
+        elif(digest != expected[filename]):
+            candidates.append(filename)
+
+    if(in_cancellation.IsCancelled()):
+        return [], 0, None
+
+    # what is left isn't in the depot, ignored files would only be turned down by p4 reconcile
+    candidates.extend([local[0] for local in localfiles.values() if not IsFileIgnored(local[0])])
+
+    digests = ComputeDigests(tohash, index, in_cancellation)
+    for filename, digest in digests.items():
+        if(digest != expected[filename]):
+            candidates.append(filename)
+    index.Save()
+    return candidates, index.hits, None
+
+class ReconcileThread(threading.Thread):
+    current = None
+
+    def __init__(self, window, folder):
+        self.window = window
+        self.folder = folder
+        self.cancellation = PerforceCancellation()
+        self.panel = ShowOutputPanel(window, 'perforce_reconcile', "Looking for files changed outside of Perforce in " + folder + "...\n")
+        threading.Thread.__init__(self)
+
+    def Output(self, text):
+        sublime.set_timeout(lambda: AppendToOutputPanel(self.panel, text), 0)
+
+    def run(self):
+        candidates, skipped, error = FindChangedFiles(self.folder, self.cancellation)
+        if(self.cancellation.IsCancelled()):
+            self.Output("Reconcile cancelled\n")
+            return
+        if(error):
+            self.Output(error + "\nReconcile aborted, the files of the depot couldn't be listed\n")
+            ShowStatus("Perforce: reconcile of " + self.folder + " aborted")
+            return
+
+        self.Output(str(len(candidates)) + " files differ from the have revision, " + str(skipped) + " were unchanged since the last reconcile\n")
+        opened = []
+        errors = 0
+        if(candidates):
+            for record in PerforceRecords(['-x', '-', 'reconcile'], '\n'.join(candidates) + '\n', self.folder, self.cancellation):
+                if(record.GetCode() == 'error'):
+                    if(record.IsError()):
+                        errors += 1
+                    self.Output(record.GetMessage() + '\n')
+                elif('clientFile' in record):
+                    opened.append(record['clientFile'])
+                    self.Output(record.get('depotFile', '') + ' - opened for ' + record.get('action', 'edit') + '\n')
+
+        if(opened):
+            file_state_index.RequestRefresh(opened)
+            InvalidateChangelistStores()
+
+        summary = "Reconciled " + self.folder + ", " + str(len(opened)) + " files opened"
+        if(errors):
+            summary += ", " + str(errors) + " errors"
+        self.Output(summary + "\n")
+        ShowStatus("Perforce: " + summary)
+
+class PerforceReconcileFolderCommand(sublime_plugin.WindowCommand):
+    def run(self, dirs = None):
+        folder = dirs and dirs[0] or GetWindowFolder(self.window)
+        if(not folder):
+            WarnUser("No folder to reconcile")
+            return
+        if(ReconcileThread.current and ReconcileThread.current.isAlive()):
+            WarnUser("A reconcile is already running.")
+            return
+        ReconcileThread.current = ReconcileThread(self.window, folder)
+        ReconcileThread.current.start()
+
+# Gutter Diff section
+# Markers for added, modified and deleted lines, computed locally against the cached have revision
+GUTTER_MARKERS = (('added', 'markup.inserted', 'circle'), ('modified', 'markup.changed', 'dot'), ('deleted', 'markup.deleted', 'bookmark'))
+
+def ComputeLineChanges(in_baselines, in_lines):
+    # the common head and tail are skipped so only the edited region goes through SequenceMatcher
+    limit = min(len(in_baselines), len(in_lines))
+    start = 0
+    while(start < limit and in_baselines[start] == in_lines[start]):
+        start += 1
+    end = 0
+    while(end < limit - start and in_baselines[-1 - end] == in_lines[-1 - end]):
+        end += 1
+
+    changes = {'added': [], 'modified': [], 'deleted': []}
+    matcher = difflib.SequenceMatcher(None, in_baselines[start:len(in_baselines) - end], in_lines[start:len(in_lines) - end])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if(tag == 'insert'):
+            changes['added'].extend(range(start + j1, start + j2))
+        elif(tag == 'replace'):
+            changes['modified'].extend(range(start + j1, start + j2))
+        elif(tag == 'delete'):
+            changes['deleted'].append(start + j1)
+    return changes
+
+class GutterDiffWorker(object):
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.baselines = {}
+        self.worker = None
+
+    def Submit(self, in_view, in_generation, in_depotfile, in_revision, in_text):
+        self.lock.acquire()
+        try:
+            self.generations[in_view.id()] = in_generation
+            if(self.worker is None or not self.worker.isAlive()):
+                self.worker = threading.Thread(target=self.ProcessRequests)
+                self.worker.setDaemon(True)
+                self.worker.start()
+        finally:
+            self.lock.release()
+
+        self.queue.put((in_view, in_generation, in_depotfile, in_revision, in_text))
+
+    def IsCurrent(self, in_view, in_generation):
+        return self.generations.get(in_view.id()) == in_generation
+
+    def GetBaseLines(self, in_depotfile, in_revision):
+        key = in_depotfile + '#' + in_revision
+        perforce_stats.CountCache('gutter base lines', key in self.baselines)
+        if(not key in self.baselines):
+            content, err = depot_cache.Read(in_depotfile, in_revision)
+            if(err):
+                WarnUser(err)
+                return None
+
+            # only the revisions of the open views are kept decoded
+            if(len(self.baselines) > 32):
+                self.baselines.clear()
+            # view.substr returns unicode, byte strings would never compare equal on non-ASCII lines
+            self.baselines[key] = content.decode('utf-8', 'replace').splitlines()
+        return self.baselines[key]
+
+    def ProcessRequests(self):
+        while(True):
+            view, generation, depotfile, revision, text = self.queue.get()
+
+            # keystrokes that came in since then have queued a newer request for this view
+            if(not self.IsCurrent(view, generation)):
+                continue
+
+            baselines = self.GetBaseLines(depotfile, revision)
+            if(baselines is None):
+                continue
+
+            changes = ComputeLineChanges(baselines, text.splitlines())
+            sublime.set_timeout(lambda view=view, generation=generation, changes=changes: self.Apply(view, generation, changes), 0)
+
+    def Apply(self, in_view, in_generation, in_changes):
+        if(not self.IsCurrent(in_view, in_generation)):
+            return
+
+        lastline = in_view.rowcol(in_view.size())[0]
+        for name, scope, icon in GUTTER_MARKERS:
+            regions = []
+            for line in in_changes[name]:
+                point = in_view.text_point(min(line, lastline), 0)
+                regions.append(sublime.Region(point, point))
+            in_view.add_regions('perforce_gutter_' + name, regions, scope, icon, getattr(sublime, 'HIDDEN', 0))
+
+gutter_diff_worker = GutterDiffWorker()
+
+def ClearGutterMarkers(in_view):
+    for name, scope, icon in GUTTER_MARKERS:
+        in_view.erase_regions('perforce_gutter_' + name)
+
+class PerforceGutterDiff(sublime_plugin.EventListener):
+    generations = {}
+
+    def on_load(self, view):
+        self.Schedule(view, 0)
+
+    def on_post_save(self, view):
+        self.Schedule(view, 0)
+
+    def on_modified(self, view):
+        self.Schedule(view, sublime.load_settings('Perforce.sublime-settings').get('perforce_gutter_diff_delay'))
+
+    def on_close(self, view):
+        self.generations.pop(view.id(), None)
+
+    def Schedule(self, view, delay):
+        if(not view.file_name() or not sublime.load_settings('Perforce.sublime-settings').get('perforce_gutter_diff_enabled')):
+            return
+
+        generation = self.generations.get(view.id(), 0) + 1
+        self.generations[view.id()] = generation
+        sublime.set_timeout(lambda: self.Update(view, generation), delay)
+
+    def Update(self, view, generation):
+        if(self.generations.get(view.id()) != generation or not view.file_name()):
+            return
+
+        state = file_state_index.Peek(view.file_name())
+        if(state is None or not state.depotFile or not state.haveRev or not state.action in ('edit', 'integrate')):
+            ClearGutterMarkers(view)
+            return
+
+        # reading the buffer is the only part done on the UI thread
+        text = view.substr(sublime.Region(0, view.size()))
+        gutter_diff_worker.Submit(view, generation, state.depotFile, state.haveRev, text)
+
+# Graphical Diff With Depot section
+def WaitForDiffTool(process, in_filename, in_remove):
+    process.communicate()
+    if(not in_remove):
+        return
+    try:
+        os.unlink(in_filename)
+    except OSError:
+        pass # the diff tool may still hold it on Windows, the temp folder gets cleaned eventually
+
+def GraphicalDiffWithDepot(self, in_folder, in_filename, in_depotfile = None, in_revision = None):
+    perforce_settings = sublime.load_settings('Perforce.sublime-settings')
+
+    # Create a uniquely named temporary file to hold the depot version
+    handle, depotFilePath = tempfile.mkstemp(prefix='depot', suffix='_' + in_filename)
+    os.close(handle)
+    depotFileName = os.path.basename(depotFilePath)
+
+    # the have revision unless the file history asked for another one
+    depotfile, revision = in_depotfile, in_revision
+    if(depotfile is None):
+        depotfile, revision = depot_cache.GetHaveRevision(os.path.join(in_folder, in_filename))
+
+    # it comes from the local cache when it was fetched before
+    if(depotfile and depot_cache.IsEnabled()):
+        success, message = depot_cache.ExtractTo(depotfile, revision, depotFilePath)
+        if(not success):
+            os.unlink(depotFilePath)
+            return 0, message
+    else:
+        # p4 writes the depot revision straight to disk, the content never goes through the plugin
+        target = in_filename + '#have'
+        if(in_depotfile):
+            target = in_depotfile + '#' + in_revision
+        records, errors = PerforceCommand(['print', '-q', '-o', depotFilePath, target], None, in_folder)
+        if(errors):
+            os.unlink(depotFilePath)
+            return 0, '\n'.join(errors)
 
     # Launch P4Diff with both files and the same arguments P4Win passes it
     diffCommand = perforce_settings.get('perforce_graphical_diff_command')
-    diffCommand = diffCommand.replace('%depofile_path', tmp_file.name)
+    diffCommand = diffCommand.replace('%depofile_path', depotFilePath)
     diffCommand = diffCommand.replace('%depofile_name', depotFileName)
     diffCommand = diffCommand.replace('%file_path', os.path.join(in_folder, in_filename))
     diffCommand = diffCommand.replace('%file_name', in_filename)
@@ -441,10 +3576,10 @@ def GraphicalDiffWithDepot(self, in_folder, in_filename):
     command = diffCommand
     
     p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=in_folder, shell=True)
-    result, err = p.communicate()
 
-    # Clean up
-    os.unlink(tmp_file.name);
+    # launchers such as 'open -a' return before the diff tool has read the file, it is only removed when asked for
+    remove = perforce_settings.get('perforce_graphical_diff_remove_temp_file')
+    threading.Thread(target=WaitForDiffTool, args=(p, depotFilePath, remove)).start()
 
     return -1, "Executing command " + command
 
@@ -454,78 +3589,372 @@ class PerforceGraphicalDiffWithDepotCommand(sublime_plugin.TextCommand):
             folder_name, filename = os.path.split(self.view.file_name())
 
             if(IsFileInDepot(folder_name, filename)):
-                success, message = GraphicalDiffWithDepot(self, folder_name, filename)
+                RunInBackground("fetching depot version of " + filename, GraphicalDiffWithDepot, self, folder_name, filename)
             else:
-                success = 0
-                message = "File is not under the client root."
-
-            LogResults(success, message)
+                LogResults(0, "File is not under the client root.")
         else:
             WarnUser("View does not contain a file")
 
 
-# List Checked Out Files section
-class ListCheckedOutFilesThread(threading.Thread):
-    def __init__(self, window):
+# File History section
+# p4 filelog is read a page at a time, hot files have far too many revisions to list them all
+class FileRevision(object):
+    def __init__(self, depotfile, revision, change, action, user, client, timestamp, description):
+        self.depotFile = depotfile
+        self.revision = revision
+        self.change = change
+        self.action = action
+        self.user = user
+        self.client = client
+        self.timestamp = timestamp
+        self.description = description
+
+    def GetQuickPanelEntry(self):
+        date = ''
+        if(self.timestamp and self.timestamp.isdigit()):
+            date = time.strftime('%Y/%m/%d %H:%M', time.localtime(int(self.timestamp)))
+        lines = self.description.strip().splitlines() or ['']
+        return ['#' + self.revision + ' change ' + self.change + ' ' + self.action + ' by ' + self.user + '@' + self.client, lines[0].strip(), date]
+
+def GetFileHistory(in_folder, in_filename, in_depotfile = None, in_before = None):
+    # revisions are listed newest first, the next page starts below the oldest revision already loaded
+    pagesize = sublime.load_settings('Perforce.sublime-settings').get('perforce_filelog_page_size') or 50
+    target = in_filename
+    if(in_before is not None):
+        target = in_depotfile + '#' + str(in_before)
+
+    records, errors = PerforceCommand(['filelog', '-l', '-m', str(pagesize), target], None, in_folder)
+    if(errors):
+        return 0, '\n'.join(errors)
+
+    revisions = []
+    for record in records:
+        if(not 'depotFile' in record):
+            continue
+        fields = [record.GetList(name) for name in ('rev', 'change', 'action', 'user', 'client', 'time', 'desc')]
+        for values in zip(*fields):
+            revisions.append(FileRevision(record['depotFile'], *values))
+        break
+    return 1, revisions
+
+def ReadDepotRevision(in_depotfile, in_revision):
+    # revisions are memoized by the depot cache, reopening one doesn't go back to the server
+    if(depot_cache.IsEnabled()):
+        return depot_cache.Read(in_depotfile, in_revision)
+
+    records, errors = PerforceCommand(['print', '-q', in_depotfile + '#' + in_revision])
+    if(errors):
+        return None, '\n'.join(errors)
+    return ''.join([record['data'] for record in records if record.IsData()]), None
+
+def OpenDepotRevision(window, in_syntax, in_revision, in_content):
+    view = window.new_file()
+    view.set_name(os.path.basename(in_revision.depotFile) + '#' + in_revision.revision)
+    view.set_scratch(True)
+    if(in_syntax):
+        view.set_syntax_file(in_syntax)
+    edit = view.begin_edit()
+    view.insert(edit, 0, in_content.decode('utf-8', 'replace'))
+    view.end_edit(edit)
+    view.set_read_only(True)
+
+class FileHistoryThread(threading.Thread):
+    LOAD_MORE = "Load more..."
+
+    def __init__(self, window, view):
         self.window = window
+        self.filename = view.file_name()
+        self.syntax = view.settings().get('syntax')
+        self.revisions = []
+        self.depotfile = None
         threading.Thread.__init__(self)
 
-    def ConvertFileNameToFileOnDisk(self, in_filename):
-        clientroot = GetClientRoot(os.path.dirname(in_filename))
-        if(clientroot == -1):
+    def LoadPage(self):
+        before = None
+        if(self.revisions):
+            before = int(self.revisions[-1].revision) - 1
+
+        folder_name, filename = os.path.split(self.filename)
+        success, revisions = GetFileHistory(folder_name, filename, self.depotfile, before)
+        if(not success):
+            sublime.set_timeout(lambda: WarnUser(revisions), 0)
             return 0
 
-        filename = clientroot + os.sep + in_filename.replace('\\', os.sep).replace('/', os.sep)
+        self.revisions.extend(revisions)
+        if(revisions):
+            self.depotfile = revisions[0].depotFile
+        return 1
 
-        return filename
+    def HasMore(self):
+        return len(self.revisions) > 0 and int(self.revisions[-1].revision) > 1
 
-    def MakeFileListFromChangelist(self, in_changelistline):
-        files_list = []
+    def run(self):
+        if(self.LoadPage()):
+            sublime.set_timeout(self.ShowRevisions, 0)
 
-        # Launch p4 opened to retrieve all files from changelist
-        command = 'p4 opened -c ' + in_changelistline[1]
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-        result, err = p.communicate()
-        if(not err):
-            lines = result.splitlines()
-            for line in lines:
-                # remove the change #
-                poundindex = line.rfind('#')
-                cleanedfile = line[0:poundindex]
-
-                # just keep the filename
-                cleanedfile = '/'.join(cleanedfile.split('/')[3:])
-
-                file_entry = [cleanedfile[cleanedfile.rfind('/')+1:]]
-                file_entry.append("Changelist: " + in_changelistline[1])
-                file_entry.append(' '.join(in_changelistline[7:]));
-                localfile = self.ConvertFileNameToFileOnDisk(cleanedfile)
-                if(localfile != 0):
-                    file_entry.append(localfile)
-                    files_list.append(file_entry)
-        return files_list
+    def ShowRevisions(self):
+        if(not self.revisions):
+            sublime.error_message(__name__ + ': The file has no history in the depot.')
+            return
 
-    def MakeCheckedOutFileList(self):
-        files_list = self.MakeFileListFromChangelist(['','default','','','','','','Default Changelist']);
+        self.entries = [revision.GetQuickPanelEntry() for revision in self.revisions]
+        if(self.HasMore()):
+            self.entries.append([self.LOAD_MORE, "revisions #" + str(int(self.revisions[-1].revision) - 1) + " and older", ''])
+        self.window.show_quick_panel(self.entries, self.on_done)
 
-        currentuser = GetUserFromClientspec()
-        if(currentuser == -1):
-            return files_list
+    def on_done(self, picked):
+        if(picked == -1):
+            return
 
-        # Launch p4 changes to retrieve all the pending changelists
-        command = 'p4 changes -s pending -u ' + currentuser;   
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-        result, err = p.communicate()
+        if(picked >= len(self.revisions)):
+            def load_more():
+                if(self.LoadPage()):
+                    sublime.set_timeout(self.ShowRevisions, 0)
+            StartBackgroundThread(load_more)
+            return
 
-        if(not err):
-            changelists = result.splitlines()
+        self.revision = self.revisions[picked]
+        actions = ["Open #" + self.revision.revision + " read-only", "Diff #" + self.revision.revision + " against the working file"]
+        sublime.set_timeout(lambda: self.window.show_quick_panel(actions, self.on_action), 10)
+
+    def on_action(self, picked):
+        revision = self.revision
+        if(picked == 0):
+            def open_revision():
+                content, err = ReadDepotRevision(revision.depotFile, revision.revision)
+                if(err):
+                    sublime.set_timeout(lambda: WarnUser(err), 0)
+                else:
+                    sublime.set_timeout(lambda: OpenDepotRevision(self.window, self.syntax, revision, content), 0)
+            StartBackgroundThread(open_revision)
+        elif(picked == 1):
+            folder_name, filename = os.path.split(self.filename)
+            RunInBackground("fetching " + filename + "#" + revision.revision, GraphicalDiffWithDepot, None, folder_name, filename, revision.depotFile, revision.revision)
+
+class PerforceFileHistoryCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if(not self.view.file_name()):
+            WarnUser("View does not contain a file")
+            return
+
+        folder_name, filename = os.path.split(self.view.file_name())
+        if(IsFileInDepot(folder_name, filename) != 1):
+            LogResults(0, "File is not under the client root.")
+            return
+
+        FileHistoryThread(self.view.window(), self.view).start()
+
+# Annotate section
+# p4 annotate -c -u of the have revision, cached by depotFile#rev since that revision never changes
+class AnnotationCache(object):
+    SIZE = 20
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.order = []
+
+    def Get(self, in_key):
+        self.lock.acquire()
+        try:
+            lines = self.entries.get(in_key)
+            if(lines is not None):
+                self.order.remove(in_key)
+                self.order.append(in_key)
+            perforce_stats.CountCache('annotations', lines is not None)
+            return lines
+        finally:
+            self.lock.release()
+
+    def Store(self, in_key, in_lines):
+        self.lock.acquire()
+        try:
+            if(not in_key in self.entries):
+                self.order.append(in_key)
+            self.entries[in_key] = in_lines
+            while(len(self.order) > self.SIZE):
+                del self.entries[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+annotation_cache = AnnotationCache()
+
+def Annotate(in_folder, in_depotfile, in_revision):
+    key = in_depotfile + '#' + in_revision
+    lines = annotation_cache.Get(key)
+    if(lines is not None):
+        return 1, lines
+
+    # one record per line: the change that last touched it (lower), its author and date
+    lines = []
+    errors = []
+    for record in PerforceRecords(['annotate', '-c', '-u', key], None, in_folder):
+        if(record.IsError()):
+            errors.append(record.GetMessage())
+        elif('lower' in record):
+            lines.append((record['lower'], record.get('user', ''), record.get('time', ''), record.get('data', '').rstrip('\r\n')))
+
+    if(errors):
+        return 0, '\n'.join(errors)
+
+    annotation_cache.Store(key, lines)
+    return 1, lines
+
+def FormatAnnotation(in_line):
+    change, user, date, text = in_line
+    return change.rjust(8) + ' ' + user[:12].ljust(12) + ' ' + date.ljust(10) + ' | ' + text
+
+class AnnotateViewFiller(object):
+    CHUNK_LINES = 2000
+
+    # the view starts with one empty line per annotated line, the rows around the visible ones
+    # are filled first and the rest follows in chunks so the editor stays responsive on huge files
+    def __init__(self, view, lines, firstrow):
+        self.view = view
+        self.lines = lines
+        self.chunks = []
+
+        firstrow = min(max(0, firstrow), max(0, len(lines) - 1))
+        start = max(0, firstrow - self.CHUNK_LINES // 4)
+        self.chunks.append((start, min(len(lines), start + self.CHUNK_LINES)))
+        after = self.chunks[0][1]
+        before = self.chunks[0][0]
+        while(after < len(lines) or before > 0):
+            if(after < len(lines)):
+                self.chunks.append((after, min(len(lines), after + self.CHUNK_LINES)))
+                after = self.chunks[-1][1]
+            if(before > 0):
+                self.chunks.append((max(0, before - self.CHUNK_LINES), before))
+                before = self.chunks[-1][0]
+
+    def Start(self, firstrow):
+        edit = self.view.begin_edit()
+        self.view.insert(edit, 0, '\n' * max(0, len(self.lines) - 1))
+        self.view.end_edit(edit)
+        self.FillNext()
+        self.view.show(self.view.text_point(firstrow, 0))
+
+    def FillNext(self):
+        if(not self.chunks or self.view.window() is None):
+            return # done, or the view was closed
+
+        start, end = self.chunks.pop(0)
+        region = sublime.Region(self.view.text_point(start, 0), self.view.text_point(end - 1, 0))
+
+        self.view.set_read_only(False)
+        edit = self.view.begin_edit()
+        self.view.replace(edit, region, '\n'.join([FormatAnnotation(line) for line in self.lines[start:end]]).decode('utf-8', 'replace'))
+        self.view.end_edit(edit)
+        self.view.set_read_only(True)
+
+        if(self.chunks):
+            sublime.set_timeout(self.FillNext, 10)
+
+class AnnotateThread(threading.Thread):
+    def __init__(self, view):
+        self.view = view
+        self.window = view.window()
+        self.filename = view.file_name()
+        self.syntax = view.settings().get('syntax')
+        self.firstrow = view.rowcol(view.visible_region().begin())[0]
+        threading.Thread.__init__(self)
+
+    def run(self):
+        depotfile, revision = depot_cache.GetHaveRevision(self.filename)
+        if(not depotfile or not revision or not revision.isdigit()):
+            sublime.set_timeout(lambda: WarnUser("The file has no revision in this workspace to annotate."), 0)
+            return
+
+        success, lines = Annotate(os.path.dirname(self.filename), depotfile, revision)
+        if(not success):
+            sublime.set_timeout(lambda: WarnUser(lines), 0)
+            return
+        if(not lines):
+            sublime.set_timeout(lambda: WarnUser(depotfile + "#" + revision + " is empty."), 0)
+            return
+
+        sublime.set_timeout(lambda: self.ShowAnnotations(depotfile, revision, lines), 0)
+
+    def ShowAnnotations(self, depotfile, revision, lines):
+        view = self.window.new_file()
+        view.set_name(os.path.basename(depotfile) + '#' + revision + ' annotated')
+        view.set_scratch(True)
+        view.settings().set('word_wrap', False)
+        if(self.syntax):
+            view.set_syntax_file(self.syntax)
+        AnnotateViewFiller(view, lines, self.firstrow).Start(self.firstrow)
+
+class PerforceAnnotateCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        if(not self.view.file_name()):
+            WarnUser("View does not contain a file")
+            return
 
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                files_list.extend(self.MakeFileListFromChangelist(changelistlinesplit))
+        folder_name, filename = os.path.split(self.view.file_name())
+        if(IsFileInDepot(folder_name, filename) != 1):
+            LogResults(0, "File is not under the client root.")
+            return
+
+        AnnotateThread(self.view).start()
 
-        return files_list
+# List Checked Out Files section
+class ListCheckedOutFilesThread(threading.Thread):
+    def __init__(self, window, folder = None):
+        self.window = window
+        self.folder = folder
+        threading.Thread.__init__(self)
+
+    def MakeCheckedOutFileList(self):
+        info, err = workspace_info_cache.Get(self.folder)
+        if(err):
+            WarnUser(err)
+            return []
+
+        if(not info.user or not info.client):
+            WarnUser("Unexpected output from 'p4 info'.")
+            return []
+
+        # a single query lists the opened files of every changelist in the workspace
+        openedfiles, errors = PerforceCommand(['opened', '-u', info.user, '-C', info.client])
+        if(not openedfiles):
+            for error in errors:
+                if(error.find("not opened") == -1):
+                    WarnUser(error)
+            return []
+
+        success, changelists = GetPendingChangelists(self.folder)
+        if(not success):
+            changelists = []
+        descriptions = {'default': 'Default Changelist'}
+        changelistorder = {'default': -1}
+        for index, changelist in enumerate(changelists):
+            descriptions[changelist.number] = changelist.GetTitle()
+            changelistorder[changelist.number] = index
+
+        # map all depot paths to local paths in one batched p4 where
+        depotfiles = [openedfile['depotFile'] for openedfile in openedfiles]
+        mappings, errors = PerforceCommand(['-c', info.client, '-x', '-', 'where'], '\n'.join(depotfiles) + '\n')
+        localpaths = {}
+        for mapping in mappings:
+            if('path' in mapping and not 'unmap' in mapping):
+                localpaths[mapping['depotFile']] = mapping['path']
+
+        files_list = []
+        for openedfile in openedfiles:
+            depotfile = openedfile['depotFile']
+            if(not depotfile in localpaths):
+                continue
+
+            changelist = openedfile.get('change', 'default')
+            file_entry = [depotfile[depotfile.rfind('/')+1:]]
+            file_entry.append("Changelist: " + changelist)
+            file_entry.append(descriptions.get(changelist, ''))
+            file_entry.append(localpaths[depotfile])
+            files_list.append((changelistorder.get(changelist, len(changelists)), file_entry))
+
+        # default changelist first, then by changelist number
+        files_list.sort(key=lambda entry: entry[0])
+        return [file_entry for order, file_entry in files_list]
 
     def run(self):
         self.files_list = self.MakeCheckedOutFileList()
@@ -549,45 +3978,42 @@ class ListCheckedOutFilesThread(threading.Thread):
 
 class PerforceListCheckedOutFilesCommand(sublime_plugin.WindowCommand):
     def run(self):
-        ListCheckedOutFilesThread(self.window).start()
+        ListCheckedOutFilesThread(self.window, GetWindowFolder(self.window)).start()
 
 # Create Changelist section
-def CreateChangelist(description):
-    # First, create an empty changelist, we will then get the cl number and set the description
-    command = 'p4 change -o'   
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
-
-    if(err):
-        return 0, err
+def CreateChangelist(description, in_folder = None):
+    success, results = CreateChangelists([description], in_folder)
+    return results[0]
 
-    # Find the description field and modify it
-    result = result.replace("<enter description here>", description)
+def CreateChangelists(in_descriptions, in_folder = None):
+    # the new changelist form is requested once and filled in for every description
+    result, err = perforce_runner.Execute(['change', '-o'], None, in_folder)
 
-    # Remove all files from the query, we want them to stay in Default
-    filesindex = result.rfind("Files:")
-    # The Files: section we want to get rid of is only present if there's files in the default changelist
-    if(filesindex > 640):
-        result = result[0:filesindex];
+    if(err):
+        return 0, [(0, err)] * len(in_descriptions)
 
-    temp_changelist_description_file = open(os.path.join(tempfile.gettempdir(), "tempchangelist.txt"), 'w')
+    template = PerforceSpec.Parse(result)
 
-    try:
-        temp_changelist_description_file.write(result)
-    finally:
-        temp_changelist_description_file.close()
+    # files opened in the default changelist stay there
+    template.Remove('Files')
 
-    command = 'p4 change -i < ' + temp_changelist_description_file.name
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=None, shell=True)
-    result, err = p.communicate()
+    results = []
+    for description in in_descriptions:
+        spec = template.Copy()
+        spec.Set('Description', description)
+        result, err = SubmitSpec('change', spec, in_folder)
 
-    # Clean up
-    os.unlink(temp_changelist_description_file.name)
+        if(err):
+            results.append((0, err))
+            continue
 
-    if(err):
-        return 0, err
+        # "Change 1234 created."
+        words = result.split(' ')
+        if(len(words) > 1 and words[1].isdigit()):
+            GetChangelistStore(in_folder).Add(words[1], description)
+        results.append((1, result))
 
-    return 1, result
+    return len([result for result in results if result[0] != 1]) == 0, results
 
 class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
     def run(self):
@@ -596,7 +4022,7 @@ class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
             self.on_done, self.on_change, self.on_cancel)
 
     def on_done(self, input):
-        success, message = CreateChangelist(input)
+        success, message = CreateChangelist(input, GetWindowFolder(self.window))
         LogResults(success, message)
 
     def on_change(self, input):
@@ -609,35 +4035,33 @@ class PerforceCreateChangelistCommand(sublime_plugin.WindowCommand):
 def MoveFileToChangelist(in_filename, in_changelist):
     folder_name, filename = os.path.split(in_filename)
 
-    command = 'p4 reopen -c ' + in_changelist + ' "' + filename + '"'
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=folder_name, shell=True)
-    result, err = p.communicate()
+    records, errors = PerforceCommand(['reopen', '-c', in_changelist, filename], None, folder_name)
 
-    if(err):
-        return 0, err
-    
-    return 1, result
+    if(errors):
+        return 0, '\n'.join(errors)
+
+    state = file_state_index.Peek(in_filename)
+    GetChangelistStore(folder_name).MoveFile(state and state.change, in_changelist)
+    file_state_index.Update(in_filename, change=in_changelist)
+    return 1, FormatRecords(records)
 
 class ListChangelistsAndMoveFileThread(threading.Thread):
     def __init__(self, window):
         self.window = window
         self.view = window.active_view()
+        self.folder = GetWindowFolder(window)
         threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, changelists = GetPendingChangelists(self.folder);
 
         resultchangelists = ['New', 'Default'];
 
         if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                # Insert at two because we receive the changelist in the opposite order and want to keep new and default on top
-                resultchangelists.insert(2, "Changelist " + changelistlinesplit[1] + " - " + ' '.join(changelistlinesplit[7:])) 
+            # changelists come sorted by number, new and default stay on top
+            resultchangelists.extend(["Changelist " + changelist.number + " - " + changelist.GetTitle() for changelist in changelists])
+        else:
+            WarnUser(changelists)
 
         return resultchangelists
 
@@ -673,7 +4097,7 @@ class ListChangelistsAndMoveFileThread(threading.Thread):
         sublime.set_timeout(move_file, 10)
 
     def on_description_done(self, input):
-        success, message = CreateChangelist(input)
+        success, message = CreateChangelist(input, self.folder)
         if(success == 1):
             # Extract the changelist name from the message
             changelist = message.split(' ')[1]
@@ -705,26 +4129,19 @@ class AddLineToChangelistDescriptionThread(threading.Thread):
     def __init__(self, window):
         self.window = window
         self.view = window.active_view()
+        self.folder = GetWindowFolder(window)
         threading.Thread.__init__(self)
 
     def MakeChangelistsList(self):
-        success, rawchangelists = GetPendingChangelists();
+        success, changelists = GetPendingChangelists(self.folder);
 
         resultchangelists = [];
 
         if(success):
-            changelists = rawchangelists.splitlines()
-
-            # for each line, extract the change, and run p4 opened on it to list all the files
-            for changelistline in changelists:
-                changelistlinesplit = changelistline.split(' ')
-                
-                # Insert at zero because we receive the changelist in the opposite order
-                # Might be more efficient to sort...
-                changelist_entry = ["Changelist " + changelistlinesplit[1]]
-                changelist_entry.append(' '.join(changelistlinesplit[7:]));
-                
-                resultchangelists.insert(0, changelist_entry) 
+            for changelist in changelists:
+                resultchangelists.append(["Changelist " + changelist.number, changelist.GetTitle(), changelist.GetSummary()])
+        else:
+            WarnUser(changelists)
 
         return resultchangelists
 
@@ -751,7 +4168,7 @@ class AddLineToChangelistDescriptionThread(threading.Thread):
         sublime.set_timeout(get_description_line, 10)
 
     def on_description_done(self, input):
-        success, message = AppendToChangelistDescription(self.changelist, input)
+        success, message = AppendToChangelistDescription(self.changelist, input, self.folder)
         
         LogResults(success, message)
     
@@ -763,4 +4180,353 @@ class AddLineToChangelistDescriptionThread(threading.Thread):
 
 class PerforceAddLineToChangelistDescriptionCommand(sublime_plugin.WindowCommand):
     def run(self):
-        AddLineToChangelistDescriptionThread(self.window).start()
\ No newline at end of file
+        AddLineToChangelistDescriptionThread(self.window).start()
+
+# Describe Changelist section
+# The file list of a changelist shows up at once, the diff of a file is only fetched when it is expanded
+DESCRIBE_SYNTAX = 'Packages/Diff/Diff.tmLanguage'
+DESCRIBE_HEADER = '==== '
+
+class DescribedFile(object):
+    def __init__(self, depotfile, revision, action):
+        self.depotFile = depotfile
+        self.revision = revision
+        self.action = action
+
+    def GetHeader(self):
+        return DESCRIBE_HEADER + self.depotFile + '#' + self.revision + ' (' + self.action + ') ===='
+
+class DescribeState(object):
+    def __init__(self, changelist, folder, pending, files):
+        self.changelist = changelist
+        self.folder = folder
+        self.pending = pending
+        self.files = files
+        self.loaded = {} # file index -> 'loading' or 'loaded'
+        self.indexes = dict([(describedfile.depotFile, index) for index, describedfile in enumerate(files)])
+
+describe_states = {} # view id -> DescribeState
+
+def DescribeChangelist(in_changelist, in_folder):
+    # returns the header text, the files and whether the changelist is still pending
+    if(in_changelist == 'default'):
+        records, errors = PerforceCommand(['opened', '-c', 'default'], None, in_folder)
+        if(errors):
+            return 0, '\n'.join(errors)
+        files = [DescribedFile(record['depotFile'], record.get('rev', 'none'), record.get('action', 'edit')) for record in records if 'depotFile' in record]
+        return 1, ("Default changelist\n\nAffected files ...\n\n", files, True)
+
+    records, errors = PerforceCommand(['describe', '-s', in_changelist], None, in_folder)
+    if(errors):
+        return 0, '\n'.join(errors)
+    for record in records:
+        if(not 'change' in record):
+            continue
+        date = ''
+        if(record.get('time')):
+            date = ' on ' + time.strftime('%Y/%m/%d %H:%M:%S', time.localtime(int(record['time'])))
+        header = "Change " + record['change'] + " by " + record.get('user', '') + "@" + record.get('client', '') + date + " (" + record.get('status', '') + ")\n\n"
+        header += ''.join(['\t' + line + '\n' for line in record.get('desc', '').rstrip('\n').split('\n')])
+        header += "\nAffected files ...\n\n"
+        files = [DescribedFile(*values) for values in zip(record.GetList('depotFile'), record.GetList('rev'), record.GetList('action'))]
+        return 1, (header, files, record.get('status') != 'submitted')
+    return 0, "Changelist " + in_changelist + " was not found."
+
+def FormatWholeFile(in_content, in_prefix):
+    lines = in_content.splitlines()
+    if(in_prefix == '+'):
+        hunk = '@@ -0,0 +1,' + str(len(lines)) + ' @@\n'
+    else:
+        hunk = '@@ -1,' + str(len(lines)) + ' +0,0 @@\n'
+    return hunk + ''.join([in_prefix + line + '\n' for line in lines])
+
+def GetDiffFileHeader(in_line):
+    # describe and diff2 start a file with '==== //depot/file#rev ...', diff -du with '--- //depot/file<tab>date'
+    if(in_line.startswith(DESCRIBE_HEADER)):
+        return in_line[len(DESCRIBE_HEADER):].split('#')[0]
+    if(in_line.startswith('--- //')):
+        return in_line[4:].split('\t')[0].split('#')[0].rstrip('\n')
+    return None
+
+def StripDiffHeaders(in_text):
+    # the header of the view already names the file, only the hunks are kept
+    lines = []
+    inhunk = False
+    for line in in_text.splitlines(True):
+        if(line.startswith(DESCRIBE_HEADER)):
+            inhunk = False
+        elif(line.startswith('@@')):
+            inhunk = True
+            lines.append(line)
+        elif(inhunk or not (line.startswith('--- ') or line.startswith('+++ '))):
+            lines.append(line)
+    return ''.join(lines)
+
+def GetDescribedFileDiff(in_state, in_file):
+    # p4 diff and diff2 leave out added and deleted files, their whole content is shown instead
+    action = in_file.action
+    if(in_state.pending):
+        if(action.find('add') != -1 or action == 'branch' or action == 'import'):
+            records, errors = PerforceCommand(['fstat', '-T', 'clientFile', in_file.depotFile], None, in_state.folder)
+            if(errors or not records):
+                return '\n'.join(errors) + '\n'
+            try:
+                localfile = open(records[0]['clientFile'], 'rb')
+                try:
+                    return FormatWholeFile(localfile.read(), '+')
+                finally:
+                    localfile.close()
+            except IOError, e:
+                return str(e) + '\n'
+        if(action.find('delete') != -1):
+            content, err = ReadDepotRevision(in_file.depotFile, in_file.revision)
+            return err and err + '\n' or FormatWholeFile(content, '-')
+        result, err = perforce_runner.Execute(['diff', '-du', in_file.depotFile], None, in_state.folder)
+        return err or StripDiffHeaders(result)
+
+    revision = int(in_file.revision)
+    if(revision <= 1 or action.find('add') != -1 or action == 'branch' or action == 'import'):
+        content, err = ReadDepotRevision(in_file.depotFile, in_file.revision)
+        return err and err + '\n' or FormatWholeFile(content, '+')
+    if(action.find('delete') != -1):
+        content, err = ReadDepotRevision(in_file.depotFile, str(revision - 1))
+        return err and err + '\n' or FormatWholeFile(content, '-')
+    result, err = perforce_runner.Execute(['diff2', '-du', in_file.depotFile + '#' + str(revision - 1), in_file.depotFile + '#' + in_file.revision], None, in_state.folder)
+    return err or StripDiffHeaders(result)
+
+def GetDescribedFileRegions(view):
+    # the file headers are found again every time, the inserted diffs move them
+    headers = [view.line(region) for region in view.find_all('^' + DESCRIBE_HEADER)]
+    return headers
+
+def GetDescribedFileAt(view, in_point):
+    headers = GetDescribedFileRegions(view)
+    index = -1
+    for header in headers:
+        if(header.begin() > in_point):
+            break
+        index += 1
+    return index, headers
+
+def InsertDescribedFileDiffs(view, in_diffs):
+    state = describe_states.get(view.id())
+    if(state is None):
+        return
+
+    # inserted from the last file up, the headers found before the first insertion stay valid
+    headers = GetDescribedFileRegions(view)
+    view.set_read_only(False)
+    edit = view.begin_edit()
+    for index, text in sorted(in_diffs, reverse=True):
+        if(state.loaded.get(index) == 'loaded'):
+            continue
+        state.loaded[index] = 'loaded'
+        if(index + 1 < len(headers)):
+            point = headers[index + 1].begin()
+        else:
+            point = view.size()
+        if(not text.endswith('\n')):
+            text += '\n'
+        view.insert(edit, point, text.decode('utf-8', 'replace'))
+    view.end_edit(edit)
+    view.set_read_only(True)
+
+class DescribedFileDiffBatch(object):
+    # diffs are handed to the UI thread in batches, expanding every file must not flood it
+    def __init__(self, view):
+        self.view = view
+        self.lock = threading.Lock()
+        self.pending = []
+        self.flushscheduled = False
+
+    def Add(self, index, text):
+        self.lock.acquire()
+        try:
+            self.pending.append((index, text))
+            if(self.flushscheduled):
+                return
+            self.flushscheduled = True
+        finally:
+            self.lock.release()
+        sublime.set_timeout(self.Flush, 100)
+
+    def Flush(self):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = []
+            self.flushscheduled = False
+        finally:
+            self.lock.release()
+        if(pending):
+            InsertDescribedFileDiffs(self.view, pending)
+
+def LoadDescribedFile(view, in_state, in_index):
+    in_state.loaded[in_index] = 'loading'
+    batch = DescribedFileDiffBatch(view)
+
+    def load():
+        batch.Add(in_index, GetDescribedFileDiff(in_state, in_state.files[in_index]))
+    StartBackgroundThread(load)
+
+class ExpandDescribedFilesThread(threading.Thread):
+    # a single p4 streams the diffs of every file, each one is inserted as soon as it is complete
+    def __init__(self, view, state):
+        self.view = view
+        self.state = state
+        self.batch = DescribedFileDiffBatch(view)
+        threading.Thread.__init__(self)
+
+    def Deliver(self, index, lines):
+        text = ''.join(lines).strip('\n')
+        if(index is not None and text):
+            self.batch.Add(index, text + '\n')
+
+    def run(self):
+        indexes = [index for index in range(len(self.state.files)) if not index in self.state.loaded]
+        for index in indexes:
+            self.state.loaded[index] = 'loading'
+
+        if(self.state.pending):
+            depotfiles = [self.state.files[index].depotFile for index in indexes]
+            records = perforce_runner.Stream(['-x', '-', 'diff', '-du'], '\n'.join(depotfiles) + '\n', self.state.folder)
+        else:
+            records = perforce_runner.Stream(['describe', '-du', self.state.changelist], None, self.state.folder)
+
+        current = None
+        lines = []
+        remainder = ''
+        for record in records:
+            if(record.GetCode() == 'error'):
+                WarnUser(record.GetMessage())
+                continue
+            chunk = remainder + record['data']
+            chunklines = chunk.splitlines(True)
+            remainder = ''
+            if(chunklines and not chunklines[-1].endswith('\n')):
+                remainder = chunklines.pop()
+            for line in chunklines:
+                depotfile = GetDiffFileHeader(line)
+                if(depotfile is not None):
+                    self.Deliver(current, lines)
+                    current = self.state.indexes.get(depotfile)
+                    lines = []
+                elif(line.startswith('+++ ') and not lines):
+                    continue # the local side of a '--- ' header
+                elif(current is not None):
+                    lines.append(line)
+        if(remainder and current is not None):
+            lines.append(remainder)
+        self.Deliver(current, lines)
+
+        # added and deleted files have no diff, they are fetched one by one when expanded
+        def finish():
+            self.batch.Flush()
+            for index in indexes:
+                if(self.state.loaded.get(index) == 'loading'):
+                    del self.state.loaded[index]
+        sublime.set_timeout(finish, 0)
+
+class DescribeChangelistThread(threading.Thread):
+    def __init__(self, window, changelist, folder):
+        self.window = window
+        self.changelist = changelist
+        self.folder = folder
+        threading.Thread.__init__(self)
+
+    def run(self):
+        success, result = DescribeChangelist(self.changelist, self.folder)
+        if(not success):
+            sublime.set_timeout(lambda: WarnUser(result), 0)
+            return
+
+        def show():
+            header, files, pending = result
+            view = self.window.new_file()
+            if(self.changelist == 'default'):
+                view.set_name("Default changelist")
+            else:
+                view.set_name("Changelist " + self.changelist)
+            view.set_scratch(True)
+            view.set_syntax_file(DESCRIBE_SYNTAX)
+            view.settings().set('perforce_describe_view', True)
+            describe_states[view.id()] = DescribeState(self.changelist, self.folder, pending, files)
+
+            text = header + ''.join([describedfile.GetHeader() + '\n' for describedfile in files])
+            edit = view.begin_edit()
+            view.insert(edit, 0, text.decode('utf-8', 'replace'))
+            view.end_edit(edit)
+            view.set_read_only(True)
+            ShowStatus("Perforce: " + str(len(files)) + " files, press enter on a file to show its diff")
+        sublime.set_timeout(show, 0)
+
+class ListChangelistsAndDescribeThread(ListChangelistsAndMoveFileThread):
+    def MakeChangelistsList(self):
+        resultchangelists = ListChangelistsAndMoveFileThread.MakeChangelistsList(self)
+        resultchangelists[0] = 'Submitted Changelist...'
+        return resultchangelists
+
+    def on_done(self, picked):
+        if picked == -1:
+            return
+        changelistlist = self.changelists_list[picked].split(' ')
+
+        def describe():
+            if(picked == 0):
+                self.window.show_input_panel('Changelist Number', '', self.on_number_done, None, None)
+            elif(len(changelistlist) > 1): # Numbered changelist
+                DescribeChangelistThread(self.window, changelistlist[1], self.folder).start()
+            else:
+                DescribeChangelistThread(self.window, 'default', self.folder).start()
+
+        sublime.set_timeout(describe, 10)
+
+    def on_number_done(self, input):
+        if(not input.strip().isdigit()):
+            WarnUser("'" + input + "' is not a changelist number.")
+            return
+        DescribeChangelistThread(self.window, input.strip(), self.folder).start()
+
+class PerforceDescribeChangelistCommand(sublime_plugin.WindowCommand):
+    def run(self, changelist = None):
+        if(changelist):
+            DescribeChangelistThread(self.window, str(changelist), GetWindowFolder(self.window)).start()
+        else:
+            ListChangelistsAndDescribeThread(self.window).start()
+
+class PerforceDescribeToggleFileCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        state = describe_states.get(self.view.id())
+        if(state is None or not len(self.view.sel())):
+            return
+
+        index, headers = GetDescribedFileAt(self.view, self.view.sel()[0].begin())
+        if(index < 0 or index >= len(state.files)):
+            return
+        if(not index in state.loaded):
+            LoadDescribedFile(self.view, state, index)
+            return
+        if(state.loaded[index] != 'loaded'):
+            return
+
+        # the diff folds under its header line
+        if(index + 1 < len(headers)):
+            end = headers[index + 1].begin() - 1
+        else:
+            end = self.view.size() - 1
+        region = sublime.Region(headers[index].end(), end)
+        if(not region.empty() and not self.view.unfold(region)):
+            self.view.fold(region)
+
+class PerforceDescribeExpandAllFilesCommand(sublime_plugin.TextCommand):
+    def run(self, edit):
+        state = describe_states.get(self.view.id())
+        if(state is not None):
+            ExpandDescribedFilesThread(self.view, state).start()
+
+    def is_enabled(self):
+        return self.view.id() in describe_states
+
+class PerforceDescribeListener(sublime_plugin.EventListener):
+    def on_close(self, view):
+        describe_states.pop(view.id(), None)
@@ -0,0 +1,311 @@
+# Stand-in for the p4 command line client used by run_benchmarks.py
+# Answers the commands the plugin issues with generated data, configured through the environment:
+#   FAKE_P4_LOG        file receiving one line per invocation, used to count spawned processes
+#   FAKE_P4_ROOT       client root, files outside of it are reported as not in the client view
+#   FAKE_P4_LATENCY    seconds to wait before answering, simulates the round trip to the server
+#   FAKE_P4_OPENED     number of opened files
+#   FAKE_P4_CHANGES    number of pending changelists the opened files are spread across
+#   FAKE_P4_FILE_SIZE  size in bytes of the files returned by p4 print
+#   FAKE_P4_REVISIONS  number of revisions p4 filelog lists for every file
+#   FAKE_P4_DESCRIBE_FILES number of files p4 describe lists
+#   FAKE_P4_DELETED    comma separated files fstat dir/... reports although they were deleted locally
+
+import hashlib
+import marshal
+import os
+import sys
+import time
+
+GLOBAL_OPTIONS_WITH_VALUE = ('-b', '-c', '-C', '-d', '-H', '-L', '-p', '-P', '-Q', '-r', '-u', '-x', '-z')
+
+root = os.environ.get('FAKE_P4_ROOT', os.getcwd())
+opened = int(os.environ.get('FAKE_P4_OPENED', '10'))
+changes = int(os.environ.get('FAKE_P4_CHANGES', '2'))
+filesize = int(os.environ.get('FAKE_P4_FILE_SIZE', '4096'))
+revisions = int(os.environ.get('FAKE_P4_REVISIONS', '120'))
+describefiles = int(os.environ.get('FAKE_P4_DESCRIBE_FILES', '5'))
+
+logname = os.environ.get('FAKE_P4_LOG')
+if(logname):
+    logfile = open(logname, 'a')
+    logfile.write(' '.join(sys.argv[1:]) + '\n')
+    logfile.close()
+
+time.sleep(float(os.environ.get('FAKE_P4_LATENCY', '0')))
+
+# split the global options from the command and its arguments
+arguments = sys.argv[1:]
+tagged = False
+argfile = None
+while(arguments and arguments[0].startswith('-')):
+    option = arguments.pop(0)
+    if(option == '-G'):
+        tagged = True
+    elif(option in GLOBAL_OPTIONS_WITH_VALUE):
+        value = arguments.pop(0)
+        if(option == '-x'):
+            argfile = value
+
+command = arguments.pop(0)
+options = {}
+files = []
+while(arguments):
+    argument = arguments.pop(0)
+    if(argument.startswith('-') and len(argument) > 1):
+        if(argument in ('-c', '-C', '-u', '-s', '-T', '-o', '-m', '-t') and arguments and not (command == 'describe' and argument == '-s')):
+            options[argument] = arguments.pop(0)
+        else:
+            options[argument] = True
+    else:
+        files.append(argument)
+
+if(argfile == '-'):
+    files += [line for line in sys.stdin.read().splitlines() if line]
+
+def Emit(record):
+    if(tagged):
+        marshal.dump(record, sys.stdout, 0)
+    else:
+        sys.stdout.write(' '.join([str(value) for key, value in sorted(record.items()) if key != 'code']) + '\n')
+
+def Error(message, severity = 3):
+    if(tagged):
+        marshal.dump({'code': 'error', 'severity': severity, 'generic': 17, 'data': message + '\n'}, sys.stdout, 0)
+    else:
+        sys.stderr.write(message + '\n')
+
+def GetChange(index):
+    changenumber = index % (changes + 1)
+    if(changenumber == 0):
+        return 'default'
+    return str(100 + changenumber)
+
+def ToLocal(depotfile):
+    return os.path.join(root, *depotfile[len('//depot/'):].split('/'))
+
+def ToDepot(filename):
+    if(filename.startswith('//')):
+        return filename.split('#')[0]
+    filename = os.path.abspath(filename.split('#')[0])
+    return '//depot/' + os.path.relpath(filename, root).replace(os.sep, '/')
+
+def IsUnderRoot(filename):
+    return filename.startswith('//') or os.path.abspath(filename).startswith(root + os.sep)
+
+if(command == 'info'):
+    Emit({'code': 'stat', 'userName': 'bench', 'clientName': 'bench_ws', 'clientRoot': root, 'clientHost': 'benchhost', 'serverAddress': 'fake:1666'})
+
+elif(command == 'clients'):
+    Emit({'code': 'stat', 'client': 'bench_ws', 'Owner': 'bench', 'Root': root, 'Host': ''})
+    Emit({'code': 'stat', 'client': 'bench_elsewhere', 'Owner': 'bench', 'Root': root, 'Host': 'some-other-machine'})
+
+elif(command == 'opened'):
+    for index in range(opened):
+        depotfile = '//depot/project/file%d.c' % index
+        Emit({'code': 'stat', 'depotFile': depotfile, 'clientFile': depotfile.replace('//depot', '//bench_ws'), 'rev': '3', 'haveRev': '3',
+            'action': 'edit', 'change': GetChange(index), 'type': 'text', 'user': 'bench', 'client': 'bench_ws'})
+
+elif(command == 'changes'):
+    # every tenth pending changelist has shelved files
+    for changenumber in range(changes, 0, -1):
+        if('shelved' in arguments and changenumber % 10):
+            continue
+        Emit({'code': 'stat', 'change': str(100 + changenumber), 'desc': 'Pending change %d\n' % changenumber, 'status': 'pending', 'user': 'bench', 'client': 'bench_ws'})
+
+elif(command == 'where'):
+    for filename in files:
+        depotfile = ToDepot(filename)
+        Emit({'code': 'stat', 'depotFile': depotfile, 'clientFile': depotfile.replace('//depot', '//bench_ws'), 'path': ToLocal(depotfile)})
+
+elif(command == 'fstat'):
+    # dir/... lists the local files, except the .new ones which aren't in the depot, and FAKE_P4_DELETED ones
+    expanded = []
+    for filename in files:
+        filename = filename.split('#')[0]
+        if(filename.endswith('...') and not filename.startswith('//')):
+            folder = os.path.dirname(filename)
+            for dirpath, dirnames, filenames in os.walk(folder):
+                expanded.extend([os.path.join(dirpath, name) for name in sorted(filenames) if not name.endswith('.new')])
+            expanded.extend([ToDepot(os.path.join(folder, name)) for name in os.environ.get('FAKE_P4_DELETED', '').split(',') if name])
+        else:
+            expanded.append(filename)
+    files = expanded
+
+    for filename in files:
+        if(not IsUnderRoot(filename)):
+            Error('%s - file(s) not in client view.' % filename, 2)
+        elif(not filename.startswith('//') and not os.path.isfile(filename)):
+            Error('%s - no such file(s).' % filename, 2)
+        else:
+            depotfile = ToDepot(filename)
+            record = {'code': 'stat', 'depotFile': depotfile, 'clientFile': ToLocal(depotfile), 'isMapped': '', 'haveRev': '3', 'headRev': '3',
+                'headAction': 'edit', 'headType': 'text'}
+            # file names ask for the states the plugin flags: behind.c is out of date, shared.c opened elsewhere
+            if(depotfile.find('behind') != -1):
+                record['headRev'] = '5'
+            if(depotfile.find('shared') != -1):
+                record['otherOpen0'] = 'someone@their_ws'
+                record['otherLock0'] = 'someone@their_ws'
+                record['otherOpen'] = '1'
+            # the digest is the one of the local content, unless the file is named to have been changed outside of p4
+            if('-Ol' in options):
+                localfile = ToLocal(depotfile)
+                content = os.path.isfile(localfile) and open(localfile, 'rb').read().replace('\r\n', '\n') or ''
+                if(depotfile.find('changed') != -1):
+                    content += 'depot'
+                record['digest'] = hashlib.md5(content).hexdigest().upper()
+                record['fileSize'] = str(len(content))
+            Emit(record)
+
+elif(command in ('edit', 'add', 'delete', 'revert', 'reopen', 'reconcile')):
+    for filename in files:
+        if(not IsUnderRoot(filename)):
+            Error('%s - file(s) not in client view.' % filename, 2)
+            continue
+        record = {'code': 'stat', 'depotFile': ToDepot(filename), 'clientFile': os.path.abspath(filename), 'workRev': '3', 'action': command, 'type': 'text'}
+        if(command == 'revert'):
+            record['oldAction'] = 'edit'
+            record['action'] = 'reverted'
+        elif(command == 'reconcile'):
+            record['action'] = os.path.isfile(filename) and (filename.endswith('.new') and 'add' or 'edit') or 'delete'
+        elif(command == 'reopen'):
+            record['action'] = 'edit'
+            record['change'] = options.get('-c', 'default')
+        Emit(record)
+
+elif(command == 'move'):
+    # sources and targets alternate, the way -x - -b 2 passes them
+    for index in range(0, len(files) - 1, 2):
+        source, target = files[index], files[index + 1]
+        if(not IsUnderRoot(source) or not IsUnderRoot(target)):
+            Error('%s - file(s) not in client view.' % target, 2)
+            continue
+        if(not '-k' in options):
+            # moves the local files too, a folder/... pair moves every file under the folder
+            if(source.endswith('...')):
+                source, target = os.path.dirname(source), os.path.dirname(target)
+            if(not os.path.isdir(os.path.dirname(target))):
+                os.makedirs(os.path.dirname(target))
+            os.rename(source, target)
+        Emit({'code': 'stat', 'depotFile': ToDepot(target), 'fromFile': ToDepot(source), 'clientFile': os.path.abspath(target), 'action': 'move/add'})
+
+elif(command == 'set'):
+    # p4 set prints NAME=value (set) for the variables it finds
+    for name in files or ['P4PORT']:
+        if(os.environ.get(name)):
+            sys.stdout.write('%s=%s\n' % (name, os.environ[name]))
+
+elif(command == 'print'):
+    line = 'generated line of depot content\n'
+    content = (line * (filesize // len(line) + 1))[:filesize]
+    header = {'code': 'stat', 'depotFile': ToDepot(files[-1]), 'rev': '3', 'change': '99', 'action': 'edit', 'type': 'text', 'fileSize': str(filesize)}
+    if('-o' in options):
+        output = open(options['-o'], 'wb')
+        output.write(content)
+        output.close()
+        Emit(header)
+    else:
+        if(not '-q' in options):
+            Emit(header)
+        for offset in range(0, len(content), 4096):
+            Emit({'code': 'text', 'data': content[offset:offset + 4096]})
+
+elif(command == 'sync'):
+    # every file under the root, or under the given paths, is updated to #4
+    synced = 0
+    for folder, subfolders, filenames in os.walk(root):
+        for filename in sorted(filenames):
+            localname = os.path.join(folder, filename)
+            if(files and not [path for path in files if localname.startswith(path.rstrip('.').rstrip(os.sep)) or localname == os.path.abspath(path)]):
+                continue
+            Emit({'code': 'stat', 'depotFile': ToDepot(localname), 'clientFile': localname, 'rev': '4', 'action': 'updated', 'fileSize': '1'})
+            sys.stdout.flush()
+            synced += 1
+            time.sleep(float(os.environ.get('FAKE_P4_SYNC_DELAY', '0')))
+    if(not synced):
+        Error('%s - file(s) up-to-date.' % ' '.join(files), 2)
+
+elif(command == 'filelog'):
+    for filename in files:
+        depotfile, separator, head = filename.partition('#')
+        head = min(int(head or revisions), revisions)
+        record = {'code': 'stat', 'depotFile': ToDepot(depotfile)}
+        for index, rev in enumerate(range(head, max(head - int(options.get('-m', head)), 0), -1)):
+            record['rev%d' % index] = str(rev)
+            record['change%d' % index] = str(1000 + rev)
+            record['action%d' % index] = rev == 1 and 'add' or 'edit'
+            record['user%d' % index] = 'bench'
+            record['client%d' % index] = 'bench_ws'
+            record['time%d' % index] = str(1300000000 + rev * 3600)
+            record['desc%d' % index] = 'Revision %d\nwith a second line\n' % rev
+        Emit(record)
+
+elif(command == 'annotate'):
+    # the lines of p4 print, each one attributed to one of the file's changes
+    linecount = filesize // len('generated line of depot content\n') + 1
+    Emit({'code': 'stat', 'depotFile': ToDepot(files[-1]), 'rev': '3', 'change': '1003', 'action': 'edit', 'type': 'text'})
+    for index in range(linecount):
+        change = str(1001 + index % 3)
+        Emit({'code': 'stat', 'lower': change, 'upper': change, 'user': 'bench', 'time': '2011/03/18', 'data': 'generated line of depot content\n'})
+
+elif(command == 'describe'):
+    # changelists below 100 are submitted, their first file was added and their second one deleted
+    changenumber = int(files[0])
+    described = ['//depot/project/file%d.c' % index for index in range(describefiles)]
+    actions = ['add', 'delete'] + ['edit'] * max(0, describefiles - 2)
+    revs = ['1', '4'] + ['3'] * max(0, describefiles - 2)
+    status = changenumber < 100 and 'submitted' or 'pending'
+    if(tagged):
+        record = {'code': 'stat', 'change': str(changenumber), 'user': 'bench', 'client': 'bench_ws', 'time': '1300000000',
+            'desc': 'Change %d\nsecond line\n' % changenumber, 'status': status}
+        for index in range(describefiles):
+            record['depotFile%d' % index] = described[index]
+            record['action%d' % index] = actions[index]
+            record['rev%d' % index] = revs[index]
+        Emit(record)
+    else:
+        sys.stdout.write('Change %d by bench@bench_ws on 2011/03/18\n\n\tChange %d\n\nAffected files ...\n\n' % (changenumber, changenumber))
+        for index in range(describefiles):
+            sys.stdout.write('... %s#%s %s\n' % (described[index], revs[index], actions[index]))
+        sys.stdout.write('\nDifferences ...\n\n')
+        for index in range(describefiles):
+            sys.stdout.write('==== %s#%s (text) ====\n\n' % (described[index], revs[index]))
+            if(actions[index] == 'edit'):
+                sys.stdout.write('@@ -1 +1 @@\n-old line %d\n+new line %d\n\n' % (index, index))
+            # written in pieces, the plugin has to show what arrived while p4 is still running
+            sys.stdout.flush()
+
+elif(command == 'diff'):
+    # unified diffs of opened files come with patch style headers
+    for filename in files:
+        depotfile = ToDepot(filename)
+        sys.stdout.write('--- %s\t2011/03/18 10:00:00\n+++ %s\t2011/03/18 10:05:00\n@@ -1 +1 @@\n-old line\n+new line\n' % (depotfile, ToLocal(depotfile)))
+
+elif(command == 'diff2'):
+    depotfile = ToDepot(files[1])
+    sys.stdout.write('==== %s#2 (text) - %s#3 (text) ==== content\n@@ -1 +1 @@\n-old line\n+new line\n' % (depotfile, depotfile))
+
+elif(command == 'change'):
+    if('-o' in options and tagged):
+        for changenumber in files or [options['-o']]:
+            Emit({'code': 'stat', 'Change': changenumber, 'Client': 'bench_ws', 'User': 'bench', 'Status': 'pending',
+                'Description': 'Pending change %s\n' % changenumber, 'Files0': '//depot/project/file%s.c' % changenumber})
+    elif('-o' in options):
+        sys.stdout.write('Change:\tnew\n\nClient:\tbench_ws\n\nUser:\tbench\n\nStatus:\tnew\n\nDescription:\n\t<enter description here>\n')
+        if(opened):
+            sys.stdout.write('\nFiles:\n')
+            for index in range(opened):
+                if(GetChange(index) == 'default'):
+                    sys.stdout.write('\t//depot/project/file%d.c\t# edit\n' % index)
+    elif('-i' in options):
+        changenumber = 'new'
+        for line in sys.stdin.read().splitlines():
+            if(line.startswith('Change:')):
+                changenumber = line.split(':', 1)[1].strip()
+        if(changenumber == 'new'):
+            sys.stdout.write('Change 200 created.\n')
+        else:
+            sys.stdout.write('Change %s updated.\n' % changenumber)
+
+else:
+    Error('fake p4: unsupported command ' + command)
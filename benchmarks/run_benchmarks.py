@@ -0,0 +1,189 @@
+# Measures the plugin against fake_p4.py instead of a live server
+# usage: python run_benchmarks.py [--latency 0.05] [--opened 5000] [--changes 50] [--file-size 1048576] [--repeat 3]
+# Every scenario starts with cold caches and reports its wall time and the p4 processes it spawned.
+# Runs with the same Python 2 as Sublime Text 2, on a system with a POSIX shell.
+
+import optparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(benchmarks_folder))
+sys.path.insert(0, benchmarks_folder) # the sublime stubs win over any real module
+
+class NullOutput(object):
+    def write(self, text):
+        pass
+
+def CreateFakeP4(in_folder):
+    bin_folder = os.path.join(in_folder, 'bin')
+    os.makedirs(bin_folder)
+    wrapper = os.path.join(bin_folder, 'p4')
+    wrapperfile = open(wrapper, 'w')
+    try:
+        wrapperfile.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(benchmarks_folder, 'fake_p4.py')))
+    finally:
+        wrapperfile.close()
+    os.chmod(wrapper, stat.S_IRWXU)
+    return bin_folder
+
+def CreateWorkspaceFiles(in_root, in_count):
+    filenames = []
+    folder = os.path.join(in_root, 'project')
+    os.makedirs(folder)
+    for index in range(in_count):
+        filename = os.path.join(folder, 'file%d.c' % index)
+        localfile = open(filename, 'w')
+        try:
+            localfile.write('local content of file %d\n' % index)
+        finally:
+            localfile.close()
+        os.chmod(filename, stat.S_IREAD)
+        filenames.append(filename)
+    return filenames
+
+def ReadSpawnLog(in_logname):
+    if(not os.path.isfile(in_logname)):
+        return []
+    logfile = open(in_logname)
+    try:
+        return logfile.read().splitlines()
+    finally:
+        logfile.close()
+
+def GetCommandCounts(in_invocations):
+    counts = {}
+    for invocation in in_invocations:
+        arguments = invocation.split()
+        index = 0
+        while(index < len(arguments) and arguments[index].startswith('-')):
+            if(arguments[index] in ('-x', '-c', '-C', '-u', '-p', '-b', '-z')):
+                index += 1
+            index += 1
+        command = index < len(arguments) and arguments[index] or '?'
+        counts[command] = counts.get(command, 0) + 1
+    return counts
+
+def WaitForBackgroundThreads():
+    # prefetches and index refreshes started by a scenario belong to it
+    for thread in threading.enumerate():
+        if(thread is not threading.currentThread() and not thread.isDaemon()):
+            thread.join()
+
+def ResetPlugin(Perforce):
+    Perforce.workspace_info_cache.Invalidate()
+    Perforce.workspace_registry.Invalidate()
+    Perforce.file_state_index.Clear()
+    Perforce.InvalidateChangelistStores()
+    Perforce.perforce_stats.Reset()
+    shutil.rmtree(Perforce.GetCacheDirectory(), True)
+
+# Scenarios
+def ListCheckedOutFiles(Perforce, workspace):
+    files_list = Perforce.ListCheckedOutFilesThread(None).MakeCheckedOutFileList()
+    assert len(files_list) == workspace['opened'], "listed %d of %d opened files" % (len(files_list), workspace['opened'])
+
+def CheckoutOneByOne(Perforce, workspace):
+    for filename in workspace['files']:
+        Perforce.Checkout(filename)
+
+def CheckoutBatch(Perforce, workspace):
+    results = Perforce.CheckoutFiles(workspace['files'])
+    assert len([result for result in results.values() if result[0] == 1]) == len(workspace['files'])
+
+def CreateChangelist(Perforce, workspace):
+    success, message = Perforce.CreateChangelist('Benchmark changelist')
+    assert success == 1, message
+
+def ListPendingChangelistsTwice(Perforce, workspace):
+    # the second picker is served from the changelist store
+    for run in range(2):
+        success, changelists = Perforce.GetPendingChangelists()
+        assert success == 1 and len(changelists) == workspace['changes'], changelists
+
+def GraphicalDiffWithDepot(Perforce, workspace):
+    folder_name, filename = os.path.split(workspace['files'][0])
+    Perforce.GraphicalDiffWithDepot(None, folder_name, filename)
+
+def GraphicalDiffWithDepotTwice(Perforce, workspace):
+    # the second diff of the same file is the common case during review
+    GraphicalDiffWithDepot(Perforce, workspace)
+    GraphicalDiffWithDepot(Perforce, workspace)
+
+SCENARIOS = [
+    ('MakeCheckedOutFileList', ListCheckedOutFiles),
+    ('Checkout (one file at a time)', CheckoutOneByOne),
+    ('CheckoutFiles (batched)', CheckoutBatch),
+    ('CreateChangelist', CreateChangelist),
+    ('GetPendingChangelists x2', ListPendingChangelistsTwice),
+    ('GraphicalDiffWithDepot', GraphicalDiffWithDepot),
+    ('GraphicalDiffWithDepot x2', GraphicalDiffWithDepotTwice),
+]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--latency', type='float', default=0.0, help='seconds the fake server waits before answering')
+    parser.add_option('--opened', type='int', default=5000, help='number of opened files')
+    parser.add_option('--changes', type='int', default=50, help='number of pending changelists')
+    parser.add_option('--file-size', type='int', default=1024 * 1024, help='size in bytes of printed depot files')
+    parser.add_option('--checkout-files', type='int', default=20, help='number of read-only files checked out')
+    parser.add_option('--repeat', type='int', default=1, help='runs of each scenario, the fastest is reported')
+    options, args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='perforce_bench_')
+    try:
+        root = os.path.join(folder, 'workspace')
+        logname = os.path.join(folder, 'p4.log')
+        workspace = {'opened': options.opened, 'changes': options.changes, 'files': CreateWorkspaceFiles(root, options.checkout_files)}
+
+        os.environ['PATH'] = CreateFakeP4(folder) + os.pathsep + os.environ.get('PATH', '')
+        os.environ['FAKE_P4_ROOT'] = root
+        os.environ['FAKE_P4_LOG'] = logname
+        os.environ['FAKE_P4_LATENCY'] = str(options.latency)
+        os.environ['FAKE_P4_OPENED'] = str(options.opened)
+        os.environ['FAKE_P4_CHANGES'] = str(options.changes)
+        os.environ['FAKE_P4_FILE_SIZE'] = str(options.file_size)
+        for name in ('P4CLIENT', 'P4PORT', 'P4USER', 'P4CONFIG'):
+            os.environ.pop(name, None)
+
+        import sublime
+        import Perforce
+        sublime.load_settings('Perforce.sublime-settings').set('perforce_graphical_diff_command', 'echo "%depofile_path" > /dev/null')
+
+        print "%d opened files in %d changelists, %d byte depot files, %.0f ms latency" % (options.opened, options.changes, options.file_size, options.latency * 1000)
+        print
+        print "%-32s %10s %8s  %s" % ("scenario", "wall ms", "spawns", "p4 commands")
+        for name, scenario in SCENARIOS:
+            best = None
+            for run in range(options.repeat):
+                ResetPlugin(Perforce)
+                if(os.path.isfile(logname)):
+                    os.unlink(logname)
+
+                stdout = sys.stdout
+                sys.stdout = NullOutput()
+                try:
+                    start = time.time()
+                    scenario(Perforce, workspace)
+                    WaitForBackgroundThreads()
+                    elapsed = time.time() - start
+                finally:
+                    sys.stdout = stdout
+
+                invocations = ReadSpawnLog(logname)
+                if(best is None or elapsed < best[0]):
+                    best = (elapsed, invocations)
+
+            elapsed, invocations = best
+            counts = GetCommandCounts(invocations)
+            print "%-32s %10.0f %8d  %s" % (name, elapsed * 1000, len(invocations), ', '.join(["%s x%d" % (command, count) for command, count in sorted(counts.items())]))
+    finally:
+        shutil.rmtree(folder, True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Headless stand-in for Sublime Text's sublime module, just enough to drive Perforce.py from run_benchmarks.py
+
+import json
+import os
+import re
+import tempfile
+
+ENCODED_POSITION = 1
+HIDDEN = 128
+
+_settings = {}
+_data_folder = tempfile.mkdtemp(prefix='perforce_bench_')
+
+class Settings(object):
+    def __init__(self, values):
+        self.values = values
+
+    def get(self, key, default = None):
+        return self.values.get(key, default)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+def StripComments(text):
+    # sublime-settings files allow // comments
+    lines = []
+    for line in text.splitlines():
+        inString = False
+        for index, character in enumerate(line):
+            if(character == '"' and (index == 0 or line[index - 1] != '\\')):
+                inString = not inString
+            elif(not inString and line[index:index + 2] == '//'):
+                line = line[:index]
+                break
+        lines.append(line)
+    return re.sub(r',(\s*})', r'\1', '\n'.join(lines))
+
+def load_settings(name):
+    if(not name in _settings):
+        settingsfile = open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), name))
+        try:
+            _settings[name] = Settings(json.loads(StripComments(settingsfile.read())))
+        finally:
+            settingsfile.close()
+    return _settings[name]
+
+def set_timeout(callback, delay):
+    callback()
+
+def status_message(message):
+    pass
+
+def error_message(message):
+    pass
+
+def packages_path():
+    return os.path.join(_data_folder, 'Packages')
+
+def windows():
+    return []
+
+def active_window():
+    return None
+
+class Region(object):
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
@@ -0,0 +1,15 @@
+# Headless stand-in for Sublime Text's sublime_plugin module, used by run_benchmarks.py
+
+class EventListener(object):
+    pass
+
+class ApplicationCommand(object):
+    pass
+
+class WindowCommand(object):
+    def __init__(self, window):
+        self.window = window
+
+class TextCommand(object):
+    def __init__(self, view):
+        self.view = view